@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+
+""" Offline benchmarks of the bot's jobs against fake Twitter API and a local forecast server.
+    Run from the repository root: python3 -m bench [--only watcher stats ...]
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import libbot
+from bench.fakes import FakeApi, FakeStatus, ForecastServer, StreamServer, TweetStream, make_followers, make_timeline
+
+
+MY_ID = 1
+WORDS = ['#AllMagadan', '#Магадан', 'Magadan', 'Колыма', '#Kolyma', 'Нагаево']
+BLACKLIST_WORDS = ['реклама', 'продам', 'скидка', 'casino']
+BLACKLIST_USERS = [str(x) for x in range(1000, 1010)]
+
+
+def setup_bot(args):
+    """ Point the bot's settings to the current (temporary) directory and synthetic data
+    """
+
+    libbot.MY_ID = MY_ID
+    libbot.WORDS = WORDS
+    libbot.BLACKLIST_USERS_FILE = 'blacklist_users'
+    libbot.BLACKLIST_WORDS_FILE = 'blacklist_words'
+    libbot.METRICS_FILE = None
+
+    with open('blacklist_users', 'w') as f:
+        f.write('\n'.join(BLACKLIST_USERS) + '\n')
+    with open('blacklist_words', 'w') as f:
+        f.write('\n'.join(BLACKLIST_WORDS) + '\n')
+
+    return TweetStream(WORDS, BLACKLIST_WORDS, BLACKLIST_USERS, retweets=args.retweets,
+                       blacklisted=args.blacklisted, seed=args.seed)
+
+
+def bench_watcher(args, record):
+    """ Search, filter and queue tweets in batches of args.batch
+    """
+
+    stream = setup_bot(args)
+    api = FakeApi(MY_ID)
+    db = libbot.Database('base.db')
+    db.start()
+    watcher = libbot.TWatcher('t_watcher', api, db)
+    try:
+        api.add_tweets(stream.generate(1))
+        watcher.start()
+        for _ in range(args.tweets // args.batch):
+            api.add_tweets(stream.generate(args.batch))
+            started = time.perf_counter()
+            watcher.step()
+            record(time.perf_counter() - started, args.batch)
+    finally:
+        watcher.executor.shutdown()
+        db.stop()
+
+
+def bench_dispatcher(args, record):
+    """ Retweet queued tweets and move them to the retweets table
+    """
+
+    stream = setup_bot(args)
+    api = FakeApi(MY_ID)
+    db = libbot.Database('base.db')
+    db.start()
+    dispatcher = libbot.TDispatcher('t_dispatcher', api, db, rate=10 ** 9, burst=10 ** 9)
+    try:
+        queued = [(x.id, x.created_at_in_seconds, x.user.id, x.user.screen_name, x.user.name, x.text)
+                  for x in stream.generate(args.dispatch)]
+        db.write(lambda cur: cur.executemany('INSERT INTO outbox (tweet_id, created, user_id, user_sn, user_n, '
+                                             'tweet_text) VALUES (?,?,?,?,?,?)', queued))
+        cur = db.reader().cursor()
+        for _ in queued:
+            row = cur.execute('SELECT tweet_id, created, user_id, user_sn, user_n, tweet_text, attempts FROM outbox '
+                              'ORDER BY tweet_id LIMIT 1').fetchone()
+            started = time.perf_counter()
+            dispatcher.dispatch(row)
+            record(time.perf_counter() - started)
+    finally:
+        db.stop()
+
+
+def bench_stream(args, record):
+    """ Follow a local filtered stream: time from a tweet coming to its retweet.
+        The stream is dropped halfway, tweets sent meanwhile are found by search after reconnection.
+    """
+
+    stream = setup_bot(args)
+    stream.retweets = stream.blacklisted = 0
+    libbot.STREAM_RECONNECT_MIN = 0.1
+    server = StreamServer(keepalive=1).start()
+    api = FakeApi(MY_ID, stream_url=server.url, timeout=5)
+    db = libbot.Database('base.db')
+    db.start()
+    scheduler = libbot.Scheduler(4)
+    dispatcher = libbot.TDispatcher('t_dispatcher', api, db, rate=10 ** 9, burst=10 ** 9)
+    watcher = libbot.TStreamWatcher('t_watcher', api, db, api, FakeStatus.NewFromJsonDict,
+                                    lambda: scheduler.wake(dispatcher))
+
+    pushed = {}
+
+    def retweeted(status_id):
+        started = pushed.pop(status_id, None)
+        if started is not None:
+            record(time.perf_counter() - started)
+
+    api.on_retweet = retweeted
+    api.add_tweets(stream.generate(1))
+    scheduler.add(watcher)
+    scheduler.add(dispatcher)
+    thread = threading.Thread(target=scheduler.run, daemon=True)
+    thread.start()
+    try:
+        while server.connections == 0:
+            time.sleep(0.01)
+        for i, status in enumerate(stream.generate(args.stream)):
+            if i == args.stream // 2:
+                server.drop()
+            if str(status.user.id) not in BLACKLIST_USERS:
+                pushed[status.id] = time.perf_counter()
+            api.add_tweets([status])
+            server.push(status.AsDict())
+            time.sleep(args.stream_interval)
+
+        deadline = time.monotonic() + 30
+        while len(pushed) > 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        server.drop()
+        scheduler.stop()
+        thread.join()
+        server.stop()
+        db.stop()
+        libbot.stop_event.clear()
+
+
+def bench_stats(args, record):
+    """ Diff today's followers list against the previous snapshot and save it
+    """
+
+    setup_bot(args)
+    followers_old, followers_new = make_followers(args.followers, args.churn, args.seed)
+    api = FakeApi(MY_ID, followers=followers_new)
+    db = libbot.Database('base.db')
+    db.start()
+    stats = libbot.TStatsMaker('t_statsmaker', api, db)
+    yesterday = str(datetime.date.today() - datetime.timedelta(days=1))
+    today = str(datetime.date.today())
+
+    def reset(cur):
+        cur.execute('DELETE FROM follower_snapshots')
+        cur.execute('DELETE FROM follower_events')
+        cur.execute('INSERT INTO follower_snapshots VALUES (?,?,?)',
+                    (yesterday, len(followers_old), libbot.pack_ids(sorted(followers_old))))
+
+    try:
+        for _ in range(args.repeat):
+            db.write(reset)
+            started = time.perf_counter()
+            stats.post_stats()
+            record(time.perf_counter() - started, len(followers_new))
+            assert db.reader().execute('SELECT count FROM follower_snapshots WHERE date=?', (today,)).fetchone()
+    finally:
+        db.stop()
+
+
+def bench_weather(args, record):
+    """ Download, parse and render forecasts which change on every request
+    """
+
+    setup_bot(args)
+    server = ForecastServer(args.periods, changing=True).start()
+    weather = libbot.TWeather('t_weather', FakeApi(MY_ID))
+    weather.urls = {kind: server.url for kind in weather.KINDS}
+    try:
+        for _ in range(args.repeat * 10):
+            for kind in weather.KINDS:
+                started = time.perf_counter()
+                weather.prepare(kind)
+                record(time.perf_counter() - started)
+    finally:
+        server.stop()
+
+
+def bench_rebuild(args, record):
+    """ Rebuild the retweets table from the bot's timeline
+    """
+
+    import bot
+
+    stream = setup_bot(args)
+    api = FakeApi(MY_ID, timeline=make_timeline(stream, args.timeline, MY_ID))
+    db = libbot.Database('base.db')
+    db.start()
+    db.stop()
+    for _ in range(args.repeat):
+        started = time.perf_counter()
+        bot.reload_retweets(api, True)
+        record(time.perf_counter() - started, args.timeline)
+        shutil.rmtree(bot.BACKUP_DIR)
+
+
+BENCHMARKS = {
+    'watcher': bench_watcher,
+    'dispatcher': bench_dispatcher,
+    'stream': bench_stream,
+    'stats': bench_stats,
+    'weather': bench_weather,
+    'rebuild': bench_rebuild,
+}
+
+
+def percentile(values, share):
+    values = sorted(values)
+
+    return values[min(int(len(values) * share), len(values) - 1)]
+
+
+def measure(func, args, memory=False):
+    """ Run a benchmark in a temporary directory. Return its latencies, the number of items done
+        and the peak memory allocated if asked for
+    """
+
+    latencies = []
+    items = [0]
+
+    def record(seconds, count=1):
+        latencies.append(seconds)
+        items[0] += count
+
+    cwd = os.getcwd()
+    tmp_dir = tempfile.mkdtemp(prefix='bench-')
+    os.chdir(tmp_dir)
+    if memory:
+        tracemalloc.start()
+    try:
+        func(args, record)
+        peak = tracemalloc.get_traced_memory()[1] if memory else None
+    finally:
+        if memory:
+            tracemalloc.stop()
+        os.chdir(cwd)
+        shutil.rmtree(tmp_dir)
+
+    return latencies, items[0], peak
+
+
+def run(name, args):
+    func = BENCHMARKS[name]
+    latencies, items, _ = measure(func, args)
+    peak = None if args.no_memory else measure(func, args, memory=True)[2]
+
+    total = sum(latencies)
+    return {
+        'benchmark': name,
+        'ops': len(latencies),
+        'items': items,
+        'items_per_second': items / total if total > 0 else None,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'peak_memory_mb': peak / 2 ** 20 if peak is not None else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the bot against fake Twitter API and forecast server')
+    parser.add_argument('--only', nargs='+', choices=sorted(BENCHMARKS), default=list(BENCHMARKS))
+    parser.add_argument('--tweets', type=int, default=20000, help='tweets found by the watcher')
+    parser.add_argument('--batch', type=int, default=200, help='tweets found by one search')
+    parser.add_argument('--retweets', type=float, default=0.1, help='share of found tweets which are retweets')
+    parser.add_argument('--blacklisted', type=float, default=0.1, help='share of blacklisted tweets')
+    parser.add_argument('--dispatch', type=int, default=200, help='tweets retweeted by the dispatcher')
+    parser.add_argument('--stream', type=int, default=200, help='tweets coming from the stream')
+    parser.add_argument('--stream-interval', type=float, default=0.01, help='seconds between tweets in the stream')
+    parser.add_argument('--followers', type=int, default=100000, help='followers of the bot')
+    parser.add_argument('--churn', type=float, default=0.01, help='share of followers changed since the last time')
+    parser.add_argument('--timeline', type=int, default=3200, help='statuses in the bot\'s timeline')
+    parser.add_argument('--periods', type=int, default=40, help='periods in a forecast')
+    parser.add_argument('--repeat', type=int, default=5, help='runs of the stats, weather and rebuild benchmarks')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--no-memory', action='store_true', help='don\'t measure peak memory (saves a second run)')
+    parser.add_argument('--json', action='store_true', help='print results as JSON lines')
+    parser.add_argument('--verbose', action='store_true', help='show the bot\'s log')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s')
+    logging.getLogger('logger').setLevel(logging.INFO if args.verbose else logging.WARNING)
+
+    if not args.json:
+        print('%-12s %8s %10s %12s %10s %10s %10s %10s' % ('benchmark', 'ops', 'items', 'items/s', 'p50 ms',
+                                                           'p95 ms', 'p99 ms', 'peak MB'))
+    for name in args.only:
+        result = run(name, args)
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print('%-12s %8d %10d %12.1f %10.2f %10.2f %10.2f %10s' % (
+                result['benchmark'], result['ops'], result['items'], result['items_per_second'] or 0,
+                result['p50_ms'], result['p95_ms'], result['p99_ms'],
+                '%.1f' % result['peak_memory_mb'] if result['peak_memory_mb'] is not None else '-'))
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
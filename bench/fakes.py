@@ -0,0 +1,389 @@
+# -*- coding: utf-8 -*-
+
+""" In-process stand-ins for Twitter API, its filtered stream and yr.no forecast server
+"""
+
+import bisect
+import calendar
+import datetime
+import email.utils
+import http.server
+import json
+import queue
+import random
+import socketserver
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+
+# Twitter's snowflake epoch in milliseconds
+TWITTER_EPOCH = 1288834974657
+
+
+def make_id(created, sequence):
+    """ Make a snowflake-like status id for the creation time
+    """
+
+    return ((int(created * 1000) - TWITTER_EPOCH) << 22) | (sequence & 0x3fffff)
+
+
+class FakeUser(object):
+    def __init__(self, user_id):
+        self.id = user_id
+        self.screen_name = 'user%d' % user_id
+        self.name = 'User %d' % user_id
+
+    def AsDict(self):
+        return {'id': self.id, 'screen_name': self.screen_name, 'name': self.name}
+
+
+class FakeStatus(object):
+    """ A status with the attributes of twitter.Status the bot uses
+    """
+
+    def __init__(self, status_id, created, user, text, retweeted_status=None):
+        self.id = status_id
+        self.created_at_in_seconds = int(created)
+        self.created_at = time.strftime('%a %b %d %H:%M:%S +0000 %Y', time.gmtime(created))
+        self.user = user
+        self.text = text
+        self.retweeted_status = retweeted_status
+
+    def AsDict(self):
+        """ Return the status in Twitter API JSON format like twitter.Status.AsDict()
+        """
+
+        data = {'id': self.id, 'created_at': self.created_at, 'user': self.user.AsDict(), 'text': self.text}
+        if self.retweeted_status is not None:
+            data['retweeted_status'] = self.retweeted_status.AsDict()
+
+        return data
+
+    @classmethod
+    def NewFromJsonDict(cls, data):
+        """ Make a status from Twitter API JSON like twitter.Status.NewFromJsonDict()
+        """
+
+        created = calendar.timegm(time.strptime(data['created_at'], '%a %b %d %H:%M:%S +0000 %Y'))
+        user = FakeUser(data['user']['id'])
+        user.screen_name = data['user']['screen_name']
+        user.name = data['user']['name']
+        retweeted_status = data.get('retweeted_status')
+        if retweeted_status is not None:
+            retweeted_status = cls.NewFromJsonDict(retweeted_status)
+
+        return cls(data['id'], created, user, data['text'], retweeted_status)
+
+
+class TweetStream(object):
+    """ Generates synthetic tweets containing the searched words. Some of them are retweets,
+        are written by blacklisted users or contain blacklisted words, in the given shares
+    """
+
+    FILLER = ('погода', 'город', 'сегодня', 'новости', 'фото', 'море', 'снег', 'дорога', 'вечер', 'утро')
+
+    def __init__(self, words, blacklist_words, blacklist_users, users=1000, retweets=0.1, blacklisted=0.1, seed=1):
+        self.words = list(words)
+        self.blacklist_words = list(blacklist_words)
+        self.blacklist_users = list(blacklist_users)
+        self.users = users
+        self.retweets = retweets
+        self.blacklisted = blacklisted
+        self.random = random.Random(seed)
+        self.sequence = 0
+
+    def status(self, created):
+        rnd = self.random
+        self.sequence += 1
+
+        words = [rnd.choice(self.FILLER) for _ in range(rnd.randint(5, 20))]
+        words.insert(rnd.randint(0, len(words)), rnd.choice(self.words))
+        user = FakeUser(rnd.randint(1000, 1000 + self.users))
+
+        roll = rnd.random()
+        if roll < self.blacklisted / 2 and self.blacklist_words:
+            words.insert(rnd.randint(0, len(words)), rnd.choice(self.blacklist_words))
+        elif roll < self.blacklisted and self.blacklist_users:
+            user = FakeUser(int(rnd.choice(self.blacklist_users)))
+
+        retweeted_status = None
+        if rnd.random() < self.retweets:
+            retweeted_status = FakeStatus(make_id(created - 60, self.sequence), created - 60,
+                                          FakeUser(rnd.randint(1000, 1000 + self.users)), ' '.join(words))
+
+        return FakeStatus(make_id(created, self.sequence), created, user, ' '.join(words), retweeted_status)
+
+    def generate(self, count, created=None):
+        """ Return count new tweets from the oldest to the newest one
+        """
+
+        if created is None:
+            created = time.time()
+
+        return [self.status(created) for _ in range(count)]
+
+
+class FakeApi(object):
+    """ Serves the methods of twitter.Api the bot uses from memory.
+        Searches return tweets added with add_tweets(), whatever the query is.
+    """
+
+    rate_limit = None
+
+    def __init__(self, my_id=1, timeline=(), followers=(), stream_url=None, timeout=None):
+        self.my_id = my_id
+        self.stream_url = stream_url
+        self.timeout = timeout
+        self.on_retweet = None
+        self.tweet_ids = []
+        self.tweets = {}
+        self.timeline = sorted(timeline, key=lambda x: x.id, reverse=True)
+        self.timeline_ids = [-x.id for x in self.timeline]
+        self.followers = list(followers)
+        self.retweeted = []
+        self.posted = []
+        self.lock = threading.Lock()
+
+    def add_tweets(self, statuses):
+        with self.lock:
+            for status in statuses:
+                if status.id not in self.tweets:
+                    bisect.insort(self.tweet_ids, status.id)
+                self.tweets[status.id] = status
+
+    def GetSearch(self, term=None, since_id=None, max_id=None, count=15, result_type=None, **kwargs):
+        with self.lock:
+            low = bisect.bisect_right(self.tweet_ids, since_id) if since_id else 0
+            high = bisect.bisect_right(self.tweet_ids, max_id) if max_id else len(self.tweet_ids)
+            ids = self.tweet_ids[max(low, high - count):high]
+
+            return [self.tweets[x] for x in reversed(ids)]
+
+    def GetUserTimeline(self, user_id=None, max_id=None, count=20, **kwargs):
+        low = bisect.bisect_left(self.timeline_ids, -max_id) if max_id else 0
+
+        return self.timeline[low:low + count]
+
+    def GetFollowerIDs(self, user_id=None, **kwargs):
+        return list(self.followers)
+
+    def PostRetweet(self, status_id, **kwargs):
+        with self.lock:
+            self.retweeted.append(status_id)
+        if self.on_retweet is not None:
+            self.on_retweet(status_id)
+
+    def PostUpdate(self, status, **kwargs):
+        with self.lock:
+            self.posted.append(status)
+
+    def GetStreamFilter(self, track=None, stall_warnings=None, **kwargs):
+        """ Yield messages of the filtered stream at stream_url. A silent stream times out after `timeout` seconds
+        """
+
+        data = urllib.parse.urlencode({'track': ','.join(track or []), 'stall_warnings': str(bool(stall_warnings))})
+        url = self.stream_url + '/statuses/filter.json'
+        with urllib.request.urlopen(url, data=data.encode('utf-8'), timeout=self.timeout) as response:
+            for line in response:
+                line = line.strip()
+                if line:
+                    yield json.loads(line.decode('utf-8'))
+
+
+def make_timeline(stream, count, my_id=1):
+    """ Return count of the bot's retweets from the newest to the oldest one, an hour apart
+    """
+
+    me = FakeUser(my_id)
+    now = time.time()
+    timeline = []
+    for i in range(count):
+        original = stream.status(now - 3600 * i - 60)
+        timeline.append(FakeStatus(make_id(now - 3600 * i, i), now - 3600 * i, me, 'RT ' + original.text, original))
+
+    return timeline
+
+
+def make_followers(count, churn=0.01, seed=1):
+    """ Return old and new followers lists of about count ids. A churn share of them is replaced
+    """
+
+    rnd = random.Random(seed)
+    old = rnd.sample(range(1, count * 10), count)
+    changed = int(count * churn)
+    new = old[changed:] + rnd.sample(range(count * 10, count * 20), changed)
+    rnd.shuffle(new)
+
+    return old, new
+
+
+def make_forecast(periods, start=None, nextupdate=None):
+    """ Return yr.no forecast XML with periods of 6 hours
+    """
+
+    if start is None:
+        start = datetime.datetime.now().replace(minute=0, second=0, microsecond=0)
+    start = start.replace(hour=start.hour - start.hour % 6)
+    if nextupdate is None:
+        nextupdate = start + datetime.timedelta(hours=6)
+
+    rnd = random.Random(periods)
+    directions = ('N', 'NE', 'E', 'SE', 'S', 'SW', 'W', 'NW')
+    lines = ['<?xml version="1.0" encoding="utf-8"?>',
+             '<weatherdata>',
+             '<meta><lastupdate>%s</lastupdate><nextupdate>%s</nextupdate></meta>'
+             % (start.strftime('%Y-%m-%dT%H:%M:%S'), nextupdate.strftime('%Y-%m-%dT%H:%M:%S')),
+             '<forecast><tabular>']
+    for i in range(periods):
+        time_from = start + datetime.timedelta(hours=6 * i)
+        time_to = time_from + datetime.timedelta(hours=6)
+        lines.append('<time from="%s" to="%s" period="%d">' % (time_from.strftime('%Y-%m-%dT%H:%M:%S'),
+                                                              time_to.strftime('%Y-%m-%dT%H:%M:%S'),
+                                                              time_from.hour // 6))
+        lines.append('<symbol number="%d" />' % rnd.randint(1, 4))
+        lines.append('<precipitation value="%.1f" />' % rnd.random())
+        lines.append('<windDirection code="%s" />' % rnd.choice(directions))
+        lines.append('<windSpeed mps="%.1f" />' % (rnd.random() * 15))
+        lines.append('<temperature unit="celsius" value="%d" />' % rnd.randint(-30, 20))
+        lines.append('<pressure unit="hPa" value="%.1f" />' % (980 + rnd.random() * 60))
+        lines.append('</time>')
+    lines.append('</tabular></forecast>')
+    lines.append('</weatherdata>')
+
+    return '\n'.join(lines).encode('utf-8')
+
+
+class ForecastServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """ Local HTTP server answering every path with a generated forecast.
+        If `changing` is set, every response is a new version of the forecast which expires at once,
+        so clients download and parse it every time. Otherwise ETag and If-None-Match are honoured.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, periods=40, changing=False):
+        super().__init__(('127.0.0.1', 0), ForecastHandler)
+        self.body = make_forecast(periods)
+        self.changing = changing
+        self.version = 0
+        self.requests = 0
+
+    @property
+    def url(self):
+        return 'http://%s:%d/forecast.xml' % self.server_address
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name='forecast_server', daemon=True).start()
+
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class ForecastHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        server.requests += 1
+        if server.changing:
+            server.version += 1
+        etag = '"%d"' % server.version
+
+        if not server.changing and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml; charset=utf-8')
+        self.send_header('Content-Length', str(len(server.body)))
+        self.send_header('ETag', etag)
+        if server.changing:
+            self.send_header('Expires', email.utils.formatdate(0, usegmt=True))
+        self.end_headers()
+        self.wfile.write(server.body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StreamServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """ Local stand-in for the filtered stream endpoint. Messages put with push() are sent to every
+        connected client as JSON lines, with an empty keep-alive line every `keepalive` seconds.
+        stall() makes the stream silent, drop() closes the connections.
+        Point twitter.Api(stream_url=server.url) or FakeApi(stream_url=server.url) to it.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, keepalive=30):
+        super().__init__(('127.0.0.1', 0), StreamHandler)
+        self.keepalive = keepalive
+        self.clients = []
+        self.lock = threading.Lock()
+        self.stalled = False
+        self.connections = 0
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server_address
+
+    def push(self, message):
+        with self.lock:
+            for client in self.clients:
+                client.put(message)
+
+    def drop(self):
+        self.push(None)
+
+    def stall(self, stalled=True):
+        self.stalled = stalled
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name='stream_server', daemon=True).start()
+
+        return self
+
+    def stop(self):
+        self.drop()
+        self.shutdown()
+        self.server_close()
+
+
+class StreamHandler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        server = self.server
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+
+        messages = queue.Queue()
+        with server.lock:
+            server.clients.append(messages)
+            server.connections += 1
+        try:
+            while True:
+                try:
+                    message = messages.get(timeout=server.keepalive)
+                except queue.Empty:
+                    if not server.stalled:
+                        self.wfile.write(b'\r\n')
+                        self.wfile.flush()
+                    continue
+                if message is None:
+                    break
+                if not server.stalled:
+                    self.wfile.write(json.dumps(message).encode('utf-8') + b'\r\n')
+                    self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            with server.lock:
+                server.clients.remove(messages)
+
+    def log_message(self, format, *args):
+        pass
@@ -3,12 +3,16 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import csv
 import datetime
+import json
 import logging
 import logging.config
+import os
 import shutil
-import sqlite3
+import socket
 import sys
+import tempfile
 import time
 
 import twitter
@@ -17,59 +21,141 @@ from libbot import *
 from config.settings import *
 
 
-def start_bot():
-    """ Bot launcher
+def start_bot(record=None):
+    """ Bot launcher. If record is a file name, API responses are recorded to it
     """
 
     # Authenticate and get API
     logger.info('Start authenticating...')
-    authed = False
-    while not authed:
-        try:
-            api = twitter.Api(consumer_key=API_KEY, consumer_secret=API_SECRET,
-                              access_token_key=ACCESS_TOKEN, access_token_secret=ACCESS_TOKEN_SECRET)
-        except Exception as err:
-            logger.error('An error occurred. Sleep for %d seconds and try again...' % SLEEP_ERROR_INTERVAL)
-            logger.error('Exception details: {}'.format(err))
-            time.sleep(SLEEP_ERROR_INTERVAL)
-        else:
-            authed = True
-            logger.info('Done')
+    api = twitter_retry.call('Authenticating',
+                             lambda: twitter.Api(consumer_key=API_KEY, consumer_secret=API_SECRET,
+                                                 access_token_key=ACCESS_TOKEN, access_token_secret=ACCESS_TOKEN_SECRET,
+                                                 timeout=HTTP_TIMEOUT))
+    logger.info('Done')
 
-    # Start threads
-    t_watcher = TWatcher('t_watcher', api)
-    t_watcher.start()
-    t_statsmaker = TStatsMaker('t_statsmaker', api)
-    t_statsmaker.start()
-    t_weather = TWeather('t_weather', api)
-    t_weather.start()
+    capture = None
+    if record is not None:
+        logger.info('Recording API responses to %s' % record)
+        capture = Capture(record)
+        api = RecordingApi(api, capture)
+
+    # Create or upgrade the database and start the writer before jobs start using it
+    db = Database(DB_FILE)
+    db.start()
+
+    # Schedule jobs. With several instances every one of them searches its share of queries,
+    # other jobs run on the instance holding their leases
+    scheduler = Scheduler(SCHEDULER_WORKERS)
+    leases = None
+    if MULTI_INSTANCE:
+        leases = Leases(db, '%s:%d' % (socket.gethostname(), os.getpid()))
+        leases.start()
+        logger.info('Running as instance %s' % leases.instance_id)
+
+    def leased(job):
+        return job if leases is None else TLeased(job, leases)
+
+    dispatcher = leased(TDispatcher('t_dispatcher', api, db))
+    if WATCH_MODE == 'stream':
+        # A separate API object: its timeout is the time the stream may be silent before it is reconnected
+        stream_api = twitter.Api(consumer_key=API_KEY, consumer_secret=API_SECRET,
+                                 access_token_key=ACCESS_TOKEN, access_token_secret=ACCESS_TOKEN_SECRET,
+                                 stream_url=STREAM_URL, timeout=STREAM_STALL_TIMEOUT)
+        scheduler.add(leased(TStreamWatcher('t_watcher', api, db, stream_api, twitter.Status.NewFromJsonDict,
+                                            lambda: scheduler.wake(dispatcher))))
+    else:
+        scheduler.add(TWatcher('t_watcher', api, db, leases))
+    scheduler.add(dispatcher)
+    scheduler.add(leased(TStatsMaker('t_statsmaker', api, db)))
+    weather = TWeather('t_weather', api, db)
+    weather.forecasts = ForecastCache(capture)
+    scheduler.add(leased(weather))
+
+    # Metrics are exposed only if asked for
+    metrics.register('bot_outbox_depth', lambda: db.reader().execute('SELECT COUNT(*) FROM outbox').fetchone()[0])
+    metrics.register('bot_db_queue_depth', db.requests.qsize)
+    metrics_server = None
+    if METRICS_PORT:
+        metrics_server = start_metrics_server(METRICS_HOST, METRICS_PORT)
+    if METRICS_FILE:
+        scheduler.add(TMetricsWriter('t_metrics'))
+
+    if BACKUP_INTERVAL:
+        scheduler.add(leased(TBackup('t_backup', db, BACKUP_DIR)))
 
     try:
-        t_watcher.join()
-        t_statsmaker.join()
-        t_weather.join()
+        scheduler.run()
     except KeyboardInterrupt:
         logger.info('KeyboardInterrupt exception caught')
 
-        logger.info('Stopping TWatcher thread...')
-        setattr(t_watcher, 'stop_now', True)
-        while t_watcher.is_alive():
-            time.sleep(0.1)
+        logger.info('Stopping jobs...')
+        scheduler.stop()
+        if leases is not None:
+            leases.stop()
+        db.stop()
+        if metrics_server is not None:
+            metrics_server.shutdown()
+        if capture is not None:
+            capture.close()
         logger.info('Done')
 
-        logger.info('Stopping TStatsMaker thread...')
-        setattr(t_statsmaker, 'stop_now', True)
-        while t_statsmaker.is_alive():
-            time.sleep(0.1)
-        logger.info('Done')
 
-        logger.info('Stopping TWeather thread...')
-        setattr(t_weather, 'stop_now', True)
-        while t_weather.is_alive():
-            time.sleep(0.1)
+def replay(capture_file, speed, db_file=None):
+    """ Feed recorded API responses through the bot's search, filter and retweet jobs.
+        Nothing is posted. The replay uses its own database and offset file.
+    """
+
+    logger.info('Loading capture %s...' % capture_file)
+    api = ReplayApi(capture_file, twitter.Status.NewFromJsonDict, speed)
+    logger.info('Done')
+
+    tmp_dir = tempfile.mkdtemp(prefix='replay-')
+    if db_file is None:
+        db_file = os.path.join(tmp_dir, 'replay.db')
+    offset_file = os.path.join(tmp_dir, OFFSET_FILE)
+    watcher_options = {'offset_file': offset_file}
+    dispatcher_options = {}
+    if not speed:
+        # Nothing is waited for: searches follow each other and retweets aren't rate limited
+        watcher_options['poll_interval'] = 0
+        dispatcher_options['rate'] = dispatcher_options['burst'] = 10 ** 9
+
+    db = Database(db_file)
+    db.start()
+
+    # Start searching right before the first recorded tweet
+    first_id = api.first_id()
+    if first_id is not None and read_offset(db.reader().cursor(), offset_file) is None:
+        db.write(lambda cur: write_offset(cur, first_id - 1))
+
+    # Recorded forecasts are rendered once
+    weather = TWeather('t_weather', api)
+    weather.forecasts = ReplayForecasts(api)
+    for kind in weather.KINDS:
+        if weather.urls[kind] in api.forecasts:
+            weather.prepare(kind)
+
+    scheduler = Scheduler(SCHEDULER_WORKERS)
+    scheduler.add(TWatcher('t_watcher', api, db, **watcher_options))
+    scheduler.add(TDispatcher('t_dispatcher', api, db, **dispatcher_options))
+    scheduler.add(TReplayEnd('t_replay_end', api, db, scheduler))
+
+    started = time.monotonic()
+    try:
+        scheduler.run()
+    except KeyboardInterrupt:
+        logger.info('KeyboardInterrupt exception caught')
+    scheduler.stop()
+    db.stop()
+    shutil.rmtree(tmp_dir)
+
+    logger.info('Replayed %d search(es) in %.1f seconds' % (api.released, time.monotonic() - started))
+    for labels, value in sorted(metrics.counter('bot_tweets_total').items()):
+        logger.info('%s: %d' % (dict(labels)['reason'], value))
+    logger.info('Retweets: %d' % len(api.retweeted))
 
 
-def rebuild_retweets():
+def rebuild_retweets(record=None):
     """ This procedure rebuilds table 'retweets'.
         It needs, for example, when the bot's admin un-retweets some statuses.
     """
@@ -111,86 +197,227 @@ def rebuild_retweets():
     else:
         logger.info('Done')
 
+    if record is None:
+        reload_retweets(api, renew_offset)
+    else:
+        logger.info('Recording API responses to %s' % record)
+        capture = Capture(record)
+        try:
+            reload_retweets(RecordingApi(api, capture), renew_offset)
+        finally:
+            capture.close()
+
+
+def reload_retweets(api, renew_offset):
+    """ Back up the database and fill table 'retweets' again from the bot's timeline
+    """
+
     if not os.path.isfile(DB_FILE):
         logger.error('Database file doesn\'t exists. Exit')
         sys.exit()
 
     logger.info('Creating backup...')
-    file_postfix = str(datetime.datetime.strftime(datetime.datetime.now(), '%Y-%m-%d_%H-%M-%S'))
-    if not os.path.isdir(BACKUP_DIR):
-        os.mkdir(BACKUP_DIR)
-    shutil.copy2(DB_FILE, os.path.join(BACKUP_DIR, '-'.join([file_postfix, DB_FILE])))
+    path = backup_database(DB_FILE, BACKUP_DIR)
     if os.path.isfile(OFFSET_FILE):
+        file_postfix = os.path.basename(path)[:-len(backup_name(DB_FILE))]
         shutil.copy2(OFFSET_FILE, os.path.join(BACKUP_DIR, '-'.join([file_postfix, OFFSET_FILE])))
     logger.info('Done')
 
-    conn = sqlite3.connect(DB_FILE)
+    # The bot may be running meanwhile, so pages are committed one by one to keep write locks short
+    conn = Database(DB_FILE).connect()
     cur = conn.cursor()
+    init_db(conn)
 
-    cur.execute('''DROP TABLE IF EXISTS retweets''')
-    conn.commit()
-    logger.info('Dropped table \'retweets\'')
-    cur.execute('''CREATE TABLE IF NOT EXISTS retweets
-                                (retweeted TIMESTAMP NOT NULL, created TIMESTAMP NOT NULL,
-                                user_id INTEGER NOT NULL, user_sn TEXT NOT NULL, user_n TEXT NOT NULL,
-                                tweet_id INTEGER NOT NULL, tweet_text TEXT NOT NULL,
-                                PRIMARY KEY (retweeted))''')
+    # The new table is filled aside and swapped in at the end, so the old one stays usable until then
+    cur.execute('''DROP TABLE IF EXISTS retweets_new''')
+    cur.execute(RETWEETS_TABLE.format('retweets_new'))
     conn.commit()
     logger.info('Created new table')
 
     count_all = 0
-    buffer = 100
-    flag = True
-    max_id = None
+    count = 0
+    offset = 0
 
-    msgs = []
+    # Retweets the running bot saves from now on may be missing in the pages read
+    started = int(time.time())
 
-    logger.info('Begin loading statuses')
+    logger.info('Begin loading statuses and writing them to DB')
     t_start = datetime.datetime.now()
-    while flag:
-        msgs_all = api.GetUserTimeline(user_id=MY_ID, max_id=max_id, count=buffer)
-
-        if len(msgs_all) < buffer:
-            flag = False
-        else:
-            max_id = msgs_all[len(msgs_all) - 1].id - 1
+    for page in iter_timeline(api, MY_ID):
+        msgs = [x for x in page if x.retweeted_status is not None]
+
+        params = [(m.retweeted_status.id, m.created_at_in_seconds, m.retweeted_status.created_at_in_seconds,
+                   m.retweeted_status.user.id, m.retweeted_status.user.screen_name, m.retweeted_status.user.name,
+                   m.retweeted_status.text) for m in msgs]
+        cur.executemany('INSERT OR IGNORE INTO retweets_new (tweet_id, retweeted, created, user_id, user_sn, user_n, '
+                        'tweet_text) VALUES (?,?,?,?,?,?,?)', params)
+        conn.commit()
 
-        msgs.extend([x for x in msgs_all if x.retweeted_status is not None])
+        if len(msgs) > 0 and msgs[0].id > offset:
+            offset = msgs[0].id
 
-        count_all += len(msgs_all)
+        count_all += len(page)
+        count += len(msgs)
         logger.info('%d statuses loaded...' % count_all)
+
+    # Indexes and rollup triggers are created in the same transaction, so no retweet saved by the running bot
+    # can get into the new table without them
+    cur.execute('BEGIN IMMEDIATE')
+    cur.execute('''INSERT OR IGNORE INTO retweets_new
+                SELECT tweet_id, retweeted, created, user_id, user_sn, user_n, tweet_text FROM retweets
+                WHERE retweeted >= ?''', (started,))
+    cur.execute('''DROP TABLE IF EXISTS retweets''')
+    cur.execute('''ALTER TABLE retweets_new RENAME TO retweets''')
+    for statement in SCHEMA:
+        cur.execute(statement)
+    rebuild_rollups(cur)
+    conn.commit()
     logger.info('Elapsed time: %s' % (datetime.datetime.now() - t_start))
 
-    count = len(msgs)
     logger.info('There are %d tweets loaded' % count_all)
     logger.info('%d of them are retweets' % count)
+    logger.info('Table \'retweets\' is replaced')
 
-    logger.info('Writing statuses to DB...')
-    offset = 0
-    t_start = datetime.datetime.now()
-    for i in range(count - 1, -1, -1):
-        m = msgs[i]
-
-        if m.id > offset:
-            offset = m.id
-
-        utc_offset = int(-time.timezone / 3600)
-        params = (time.strftime('%Y-%m-%d %H:%M:%S', datetime.datetime.timetuple(
-            datetime.datetime.strptime(m.created_at, '%a %b %d %H:%M:%S %z %Y') + datetime.timedelta(hours=utc_offset))),
-                  str(m.retweeted_status.created_at),
-                  m.retweeted_status.user.id, m.retweeted_status.user.screen_name, m.retweeted_status.user.name,
-                  m.retweeted_status.id, m.retweeted_status.text)
-        cur.execute('INSERT INTO retweets VALUES (?,?,?,?,?,?,?)', params)
+    if renew_offset:
+        cur.execute('DELETE FROM state WHERE key LIKE \'offset:%\'')
+        write_offset(cur, offset)
         conn.commit()
-    logger.info('Elapsed time: %s' % (datetime.datetime.now() - t_start))
+        write_offset_file(offset)
+        logger.info('New offset is written')
 
     conn.close()
     logger.info('Done!')
 
-    if renew_offset:
-        with open(OFFSET_FILE, 'w') as f:
-            f.write(str(offset))
-        logger.info('New offset is written')
+
+def reconcile_retweets(record=None):
+    """ Bring table 'retweets' in line with the bot's timeline, reading only its recent part
+    """
+
+    logger.info('Start authenticating...')
+    api = twitter_retry.call('Authenticating',
+                             lambda: twitter.Api(consumer_key=API_KEY, consumer_secret=API_SECRET,
+                                                 access_token_key=ACCESS_TOKEN, access_token_secret=ACCESS_TOKEN_SECRET,
+                                                 timeout=HTTP_TIMEOUT))
+    logger.info('Done')
+
+    if record is None:
+        reconcile(api)
+    else:
+        logger.info('Recording API responses to %s' % record)
+        capture = Capture(record)
+        try:
+            reconcile(RecordingApi(api, capture))
+        finally:
+            capture.close()
+
+
+def reconcile(api):
+    """ Page the timeline from the newest statuses and apply only the differences with the archive:
+        retweets missing in it are inserted, retweets missing in the timeline are deleted.
+        Paging stops after RECONCILE_STRETCH retweets in a row match the archive.
+    """
+
+    if not os.path.isfile(DB_FILE):
+        logger.error('Database file doesn\'t exists. Exit')
+        sys.exit()
+
+    # The bot may be running meanwhile, so every page is applied in its own short transaction
+    conn = Database(DB_FILE).connect()
+    cur = conn.cursor()
+    init_db(conn)
+
+    # Archive times of retweets differ from the timeline ones by a few seconds, so archive rows are
+    # only compared with the timeline part which surely covers them
+    upper = None
+    timeline_ids = set()
+    stretch = 0
+    pages = inserted = deleted = 0
+
+    t_start = datetime.datetime.now()
+    for page in iter_timeline(api, MY_ID, count=200):
+        pages += 1
+        msgs = [x for x in page if x.retweeted_status is not None]
+        if len(msgs) == 0:
+            continue
+        timeline_ids.update(m.retweeted_status.id for m in msgs)
+        if upper is None:
+            upper = msgs[0].created_at_in_seconds + RECONCILE_SLACK
+        lower = msgs[-1].created_at_in_seconds + RECONCILE_SLACK
+
+        ids = [m.retweeted_status.id for m in msgs]
+        cur.execute('SELECT tweet_id FROM retweets WHERE tweet_id IN (%s)' % ','.join('?' * len(ids)), ids)
+        archived = set(x[0] for x in cur.fetchall())
+        params = [(m.retweeted_status.id, m.created_at_in_seconds, m.retweeted_status.created_at_in_seconds,
+                   m.retweeted_status.user.id, m.retweeted_status.user.screen_name, m.retweeted_status.user.name,
+                   m.retweeted_status.text) for m in msgs if m.retweeted_status.id not in archived]
+
+        cur.execute('SELECT tweet_id FROM retweets WHERE retweeted > ? AND retweeted <= ?', (lower, upper))
+        removed = [x[0] for x in cur.fetchall() if x[0] not in timeline_ids]
+        upper = lower
+
+        if len(params) > 0 or len(removed) > 0:
+            cur.executemany('INSERT OR IGNORE INTO retweets (tweet_id, retweeted, created, user_id, user_sn, user_n, '
+                            'tweet_text) VALUES (?,?,?,?,?,?,?)', params)
+            save_hashtags(cur, [(x[0], x[1], x[6]) for x in params])
+            cur.executemany('DELETE FROM retweets WHERE tweet_id=?', ((x,) for x in removed))
+            conn.commit()
+            inserted += len(params)
+            deleted += len(removed)
+            logger.info('Page %d: %d retweet(s) inserted, %d deleted' % (pages, len(params), len(removed)))
+            stretch = 0
+        else:
+            stretch += len(msgs)
+            if stretch >= RECONCILE_STRETCH:
+                logger.info('%d retweets in a row match the archive. Stop' % stretch)
+                break
+
+    conn.close()
+    logger.info('Elapsed time: %s' % (datetime.datetime.now() - t_start))
+    logger.info('%d page(s) read, %d retweet(s) inserted, %d deleted' % (pages, inserted, deleted))
+    logger.info('Done!')
+
+
+def report(kind, date_from, date_to, output_format, top, output=None):
+    """ Write a report on the archive as CSV or JSON lines, row by row as they are read
+    """
+
+    if not os.path.isfile(DB_FILE):
+        logger.error('Database file doesn\'t exists. Exit')
+        sys.exit()
+
+    # Reports need the rollups and indexes of the current schema. The database is only written to upgrade it
+    cur = Database(DB_FILE).connect(read_only=True).cursor()
+    if cur.execute('PRAGMA user_version').fetchone()[0] < SCHEMA_VERSION:
+        conn = Database(DB_FILE).connect()
+        init_db(conn)
+        conn.close()
+
+    t_start = datetime.datetime.now()
+    columns = run_report(cur, kind, date_from, date_to, top)
+
+    f = sys.stdout if output is None else open(output, 'w', newline='', encoding='utf-8')
+    count = 0
+    try:
+        if output_format == 'csv':
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            for row in cur:
+                writer.writerow(row)
+                count += 1
+        else:
+            for row in cur:
+                f.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + '\n')
+                count += 1
+    finally:
+        if output is not None:
+            f.close()
+
+    logger.info('Report \'%s\' from %s to %s: %d row(s) in %s' % (kind, date_from, date_to, count,
+                                                                  datetime.datetime.now() - t_start))
+
+
+def parse_date(s):
+    return datetime.datetime.strptime(s, '%Y-%m-%d').date()
 
 
 def main():
@@ -200,13 +427,44 @@ def main():
     group = parser.add_mutually_exclusive_group()
     group.add_argument('-s', '--start-bot', action='store_true')
     group.add_argument('-r', '--rebuild-retweets', action='store_true')
+    group.add_argument('-b', '--backup', action='store_true', help='back up the database to BACKUP_DIR')
+    group.add_argument('--reconcile', action='store_true',
+                       help='apply differences between the recent timeline and table \'retweets\'')
+    group.add_argument('--replay', metavar='CAPTURE',
+                       help='feed a capture through the search and retweet jobs without posting anything')
+    group.add_argument('--report', choices=sorted(REPORTS),
+                       help='report on retweets or followers between --from and --to dates')
+    parser.add_argument('--record', metavar='CAPTURE', help='record API responses to a gzipped JSON lines file')
+    parser.add_argument('--replay-speed', type=float, default=1,
+                        help='replay pace relative to the recorded one, 0 to replay as fast as possible')
+    parser.add_argument('--replay-db', metavar='FILE', help='database to replay into instead of a temporary one')
+    parser.add_argument('--from', dest='date_from', metavar='YYYY-MM-DD', type=parse_date,
+                        help='first day of the report, a week before --to by default')
+    parser.add_argument('--to', dest='date_to', metavar='YYYY-MM-DD', type=parse_date, default=datetime.date.today(),
+                        help='last day of the report, today by default')
+    parser.add_argument('--format', choices=['csv', 'json'], default='csv',
+                        help='report format: CSV or JSON lines')
+    parser.add_argument('--top', type=int, default=10, help='rows in the top authors and hashtags reports')
+    parser.add_argument('-o', '--output', metavar='FILE', help='file to write the report to instead of stdout')
     args = parser.parse_args()
 
     if args.start_bot:
         logger.info('Preparing bot to start')
-        start_bot()
+        start_bot(args.record)
     elif args.rebuild_retweets:
-        rebuild_retweets()
+        rebuild_retweets(args.record)
+    elif args.backup:
+        if not os.path.isfile(DB_FILE):
+            logger.error('Database file doesn\'t exists. Exit')
+            sys.exit()
+        backup_database(DB_FILE, BACKUP_DIR)
+    elif args.reconcile:
+        reconcile_retweets(args.record)
+    elif args.replay:
+        replay(args.replay, args.replay_speed, args.replay_db)
+    elif args.report:
+        date_from = args.date_from or args.date_to - datetime.timedelta(days=6)
+        report(args.report, date_from, args.date_to, args.format, args.top, args.output)
     else:
         parser.print_help()
         sys.exit()
@@ -219,6 +477,7 @@ if __name__ == '__main__':
         os.mkdir('logs')
 
     logging.config.dictConfig(LOG_OPTIONS)
+    log_listeners = start_log_queues('logger', 'logger.decisions')
     logger = logging.getLogger('logger')
     logger.info('Logging initialized')
 
@@ -229,3 +488,7 @@ if __name__ == '__main__':
         logger.error('Exception details: {}'.format(err))
     else:
         logger.info('Thank you!')
+    finally:
+        # Flush queued records
+        for listener in log_listeners:
+            listener.stop()
@@ -1,12 +1,29 @@
 # -*- coding: utf-8 -*-
 
+import bisect
+import collections
+import concurrent.futures
+import contextlib
 import datetime
+import heapq
+import email.utils
+import gzip
+import http.server
+import json
 import logging
 import logging.config
+import logging.handlers
 import math
+import queue
+import random
+import re
+import shutil
+import socketserver
 import sqlite3
 import threading
 import time
+import unicodedata
+import urllib.error
 import urllib.request
 import xml.etree.ElementTree as ET
 
@@ -15,16 +32,552 @@ from config.settings import *
 
 logger = logging.getLogger('logger')
 
+# One JSON line per decision made about a found tweet. Tweet text is kept at DEBUG level only
+decision_logger = logging.getLogger('logger.decisions')
+
+# Set when the bot is stopping. Waits inside jobs are interrupted by it
+stop_event = threading.Event()
+
+# Database schema version kept in PRAGMA user_version
+SCHEMA_VERSION = 3
+
+# Retweets archive. Times are UNIX timestamps. The table name is a parameter for rebuild_retweets
+RETWEETS_TABLE = '''CREATE TABLE IF NOT EXISTS {}
+                 (tweet_id INTEGER NOT NULL, retweeted INTEGER NOT NULL, created INTEGER NOT NULL,
+                 user_id INTEGER NOT NULL, user_sn TEXT NOT NULL, user_n TEXT NOT NULL, tweet_text TEXT NOT NULL,
+                 PRIMARY KEY (tweet_id))'''
+
+SCHEMA = (RETWEETS_TABLE.format('retweets'),
+          '''CREATE INDEX IF NOT EXISTS retweets_retweeted ON retweets (retweeted)''',
+          '''CREATE INDEX IF NOT EXISTS retweets_user_id ON retweets (user_id, retweeted)''',
+          # Offset and other bot state values
+          '''CREATE TABLE IF NOT EXISTS state
+          (key TEXT NOT NULL, value INTEGER NOT NULL, PRIMARY KEY (key))''',
+          # Tweets accepted by TWatcher and waiting to be retweeted by TDispatcher
+          '''CREATE TABLE IF NOT EXISTS outbox
+          (tweet_id INTEGER NOT NULL, created INTEGER NOT NULL,
+          user_id INTEGER NOT NULL, user_sn TEXT NOT NULL, user_n TEXT NOT NULL, tweet_text TEXT NOT NULL,
+          attempts INTEGER NOT NULL DEFAULT 0, next_try REAL NOT NULL DEFAULT 0,
+          PRIMARY KEY (tweet_id))''',
+          # Weekly followers lists and the joins (joined=1) and leaves (joined=0) found between them
+          '''CREATE TABLE IF NOT EXISTS follower_snapshots
+          (date TEXT NOT NULL, count INTEGER NOT NULL, ids BLOB NOT NULL, PRIMARY KEY (date))''',
+          '''CREATE TABLE IF NOT EXISTS follower_events
+          (date TEXT NOT NULL, user_id INTEGER NOT NULL, joined INTEGER NOT NULL)''',
+          # Covers the churn queries
+          '''CREATE INDEX IF NOT EXISTS follower_events_date_joined ON follower_events (date, joined)''',
+          # Leases of jobs and query shards shared by bot instances (see Leases)
+          '''CREATE TABLE IF NOT EXISTS leases
+          (name TEXT NOT NULL, owner TEXT NOT NULL, expires REAL NOT NULL, PRIMARY KEY (name))''',
+          # Daily retweets rollups maintained by triggers on retweets. Days are local dates
+          '''CREATE TABLE IF NOT EXISTS daily_retweets
+          (day TEXT NOT NULL, retweets INTEGER NOT NULL, authors INTEGER NOT NULL, PRIMARY KEY (day))''',
+          '''CREATE TABLE IF NOT EXISTS daily_authors
+          (day TEXT NOT NULL, user_id INTEGER NOT NULL, user_sn TEXT NOT NULL, retweets INTEGER NOT NULL,
+          PRIMARY KEY (day, user_id))''',
+          # Covers the top authors queries
+          '''CREATE INDEX IF NOT EXISTS daily_authors_report ON daily_authors (day, user_id, retweets, user_sn)''',
+          # Hourly retweets rollup maintained by triggers on retweets. Hours are UNIX time // 3600
+          '''CREATE TABLE IF NOT EXISTS hourly_retweets
+          (hour INTEGER NOT NULL, retweets INTEGER NOT NULL, PRIMARY KEY (hour))''',
+          # Hashtags of retweets, saved by save_hashtags() where the bot adds retweets, and their daily
+          # rollup maintained by triggers on it. Retweets added otherwise just have no hashtags
+          '''CREATE TABLE IF NOT EXISTS retweet_hashtags
+          (tweet_id INTEGER NOT NULL, day TEXT NOT NULL, tag TEXT NOT NULL, PRIMARY KEY (tweet_id, tag)) WITHOUT ROWID''',
+          '''CREATE TABLE IF NOT EXISTS daily_hashtags
+          (day TEXT NOT NULL, tag TEXT NOT NULL, retweets INTEGER NOT NULL, PRIMARY KEY (day, tag)) WITHOUT ROWID''',
+          '''CREATE TRIGGER IF NOT EXISTS retweets_insert AFTER INSERT ON retweets BEGIN
+          INSERT OR IGNORE INTO daily_authors
+          VALUES (date(NEW.retweeted, 'unixepoch', 'localtime'), NEW.user_id, NEW.user_sn, 0);
+          UPDATE daily_authors SET retweets=retweets+1, user_sn=NEW.user_sn
+          WHERE day=date(NEW.retweeted, 'unixepoch', 'localtime') AND user_id=NEW.user_id;
+          INSERT OR IGNORE INTO daily_retweets VALUES (date(NEW.retweeted, 'unixepoch', 'localtime'), 0, 0);
+          UPDATE daily_retweets SET retweets=retweets+1,
+          authors=(SELECT COUNT(*) FROM daily_authors WHERE day=date(NEW.retweeted, 'unixepoch', 'localtime'))
+          WHERE day=date(NEW.retweeted, 'unixepoch', 'localtime');
+          END''',
+          '''CREATE TRIGGER IF NOT EXISTS retweets_delete AFTER DELETE ON retweets BEGIN
+          UPDATE daily_authors SET retweets=retweets-1
+          WHERE day=date(OLD.retweeted, 'unixepoch', 'localtime') AND user_id=OLD.user_id;
+          DELETE FROM daily_authors
+          WHERE day=date(OLD.retweeted, 'unixepoch', 'localtime') AND user_id=OLD.user_id AND retweets<=0;
+          UPDATE daily_retweets SET retweets=retweets-1,
+          authors=(SELECT COUNT(*) FROM daily_authors WHERE day=date(OLD.retweeted, 'unixepoch', 'localtime'))
+          WHERE day=date(OLD.retweeted, 'unixepoch', 'localtime');
+          DELETE FROM daily_retweets WHERE day=date(OLD.retweeted, 'unixepoch', 'localtime') AND retweets<=0;
+          END''',
+          '''CREATE TRIGGER IF NOT EXISTS retweets_insert_hourly AFTER INSERT ON retweets BEGIN
+          INSERT OR IGNORE INTO hourly_retweets VALUES (NEW.retweeted / 3600, 0);
+          UPDATE hourly_retweets SET retweets=retweets+1 WHERE hour=NEW.retweeted / 3600;
+          END''',
+          '''CREATE TRIGGER IF NOT EXISTS retweets_delete_hourly AFTER DELETE ON retweets BEGIN
+          UPDATE hourly_retweets SET retweets=retweets-1 WHERE hour=OLD.retweeted / 3600;
+          DELETE FROM hourly_retweets WHERE hour=OLD.retweeted / 3600 AND retweets<=0;
+          END''',
+          '''CREATE TRIGGER IF NOT EXISTS retweets_delete_hashtags AFTER DELETE ON retweets BEGIN
+          DELETE FROM retweet_hashtags WHERE tweet_id=OLD.tweet_id;
+          END''',
+          '''CREATE TRIGGER IF NOT EXISTS retweet_hashtags_insert AFTER INSERT ON retweet_hashtags BEGIN
+          INSERT OR IGNORE INTO daily_hashtags VALUES (NEW.day, NEW.tag, 0);
+          UPDATE daily_hashtags SET retweets=retweets+1 WHERE day=NEW.day AND tag=NEW.tag;
+          END''',
+          '''CREATE TRIGGER IF NOT EXISTS retweet_hashtags_delete AFTER DELETE ON retweet_hashtags BEGIN
+          UPDATE daily_hashtags SET retweets=retweets-1 WHERE day=OLD.day AND tag=OLD.tag;
+          DELETE FROM daily_hashtags WHERE day=OLD.day AND tag=OLD.tag AND retweets<=0;
+          END''')
+
+# Archive reports: column names and the query of rows between dates :date_from and :date_to inclusive
+# (or UNIX hours :start_hour and :end_hour). Queries read rollups and covering indexes only
+REPORTS = {'authors': (('user_id', 'screen_name', 'retweets'),
+                       '''SELECT user_id, MAX(user_sn), SUM(retweets) AS n FROM daily_authors
+                       WHERE day BETWEEN :date_from AND :date_to GROUP BY user_id ORDER BY n DESC, user_id
+                       LIMIT :top'''),
+           'daily': (('day', 'retweets', 'authors'),
+                     '''SELECT day, retweets, authors FROM daily_retweets
+                     WHERE day BETWEEN :date_from AND :date_to ORDER BY day'''),
+           'hourly': (('hour', 'retweets'),
+                      '''SELECT strftime('%Y-%m-%d %H:%M', hour * 3600, 'unixepoch', 'localtime'), retweets
+                      FROM hourly_retweets WHERE hour >= :start_hour AND hour < :end_hour ORDER BY hour'''),
+           'hashtags': (('hashtag', 'retweets'),
+                        '''SELECT tag, SUM(retweets) AS n FROM daily_hashtags
+                        WHERE day BETWEEN :date_from AND :date_to GROUP BY tag ORDER BY n DESC, tag LIMIT :top'''),
+           'churn': (('date', 'followers', 'joined', 'left'),
+                     '''SELECT s.date, s.count, COALESCE(SUM(e.joined), 0), COALESCE(SUM(1 - e.joined), 0)
+                     FROM follower_snapshots s LEFT JOIN follower_events e ON e.date=s.date
+                     WHERE s.date BETWEEN :date_from AND :date_to GROUP BY s.date ORDER BY s.date''')}
+
+# Twitter API error codes: "Rate limit exceeded" and "You have already retweeted this Tweet"
+TWITTER_RATE_LIMIT_EXCEEDED = 88
+TWITTER_ALREADY_RETWEETED = 327
+
+
+def local_time(s):
+    """ Convert 'YYYY-MM-DD HH:MM:SS[.ffffff]' local time to a UNIX timestamp
+    """
+
+    return int(time.mktime(time.strptime(s[0:19], '%Y-%m-%d %H:%M:%S')))
+
+
+def twitter_time(s):
+    """ Convert Twitter's created_at ('Mon Jan 01 00:00:00 +0000 2018') to a UNIX timestamp
+    """
+
+    return int(datetime.datetime.strptime(s, '%a %b %d %H:%M:%S %z %Y').timestamp())
+
+
+def snowflake_time(tweet_id):
+    """ Return the UNIX time a tweet was created at from its id
+    """
+
+    return ((tweet_id >> 22) + 1288834974657) / 1000
+
+
+def hashtags(text):
+    """ Return distinct lowercase hashtags of a tweet
+    """
+
+    return sorted(set(x.lower() for x in re.findall(r'(?<!\w)#(\w+)', text) if not x.isdigit()))
+
+
+def save_hashtags(cur, retweets):
+    """ Save hashtags of retweets given as [(tweet_id, retweeted, tweet_text), ...]
+    """
+
+    cur.executemany('INSERT OR IGNORE INTO retweet_hashtags VALUES (?, date(?, \'unixepoch\', \'localtime\'), ?)',
+                    ((tweet_id, retweeted, tag) for tweet_id, retweeted, tweet_text in retweets
+                     for tag in hashtags(tweet_text)))
+
+
+def migrate_retweets(conn):
+    """ Convert the old retweets table keyed by the retweet time string to the current schema
+    """
+
+    cur = conn.cursor()
+    cur.execute('SELECT name FROM sqlite_master WHERE type=\'table\' AND name=\'retweets\'')
+    if cur.fetchone() is None:
+        return
+
+    cur.execute('PRAGMA table_info(retweets)')
+    if [x[1] for x in cur.fetchall()][0] == 'tweet_id':
+        return
+
+    logger.info('Converting table \'retweets\' to the new schema...')
+    conn.create_function('local_time', 1, local_time)
+    conn.create_function('twitter_time', 1, twitter_time)
+    cur.execute('ALTER TABLE retweets RENAME TO retweets_old')
+    cur.execute(RETWEETS_TABLE.format('retweets'))
+    cur.execute('''INSERT OR IGNORE INTO retweets (tweet_id, retweeted, created, user_id, user_sn, user_n, tweet_text)
+                SELECT tweet_id, local_time(retweeted), twitter_time(created), user_id, user_sn, user_n, tweet_text
+                FROM retweets_old ORDER BY retweeted''')
+    cur.execute('DROP TABLE retweets_old')
+    logger.info('Done')
+
+
+def rebuild_rollups(cur):
+    """ Recompute retweets rollups and hashtags from the retweets table
+    """
+
+    cur.execute('DELETE FROM daily_authors')
+    cur.execute('DELETE FROM daily_retweets')
+    cur.execute('''INSERT INTO daily_authors
+                SELECT date(retweeted, 'unixepoch', 'localtime') AS day, user_id, MAX(user_sn), COUNT(*)
+                FROM retweets GROUP BY day, user_id''')
+    cur.execute('''INSERT INTO daily_retweets
+                SELECT day, SUM(retweets), COUNT(*) FROM daily_authors GROUP BY day''')
+    cur.execute('DELETE FROM hourly_retweets')
+    cur.execute('INSERT INTO hourly_retweets SELECT retweeted / 3600 AS hour, COUNT(*) FROM retweets GROUP BY hour')
+    cur.execute('DELETE FROM retweet_hashtags')
+    cur.execute('DELETE FROM daily_hashtags')
+    save_hashtags(cur, cur.connection.execute('SELECT tweet_id, retweeted, tweet_text FROM retweets'))
+
+
+def retweet_stats(cur, date_from, date_to, top=3):
+    """ Return the number of retweets, the number of distinct authors and the top authors
+        as [(screen name, retweets), ...] between two dates inclusive
+    """
+
+    date_from = str(date_from)
+    date_to = str(date_to)
+
+    cur.execute('SELECT SUM(retweets) FROM daily_retweets WHERE day BETWEEN ? AND ?', (date_from, date_to))
+    retweets = cur.fetchone()[0] or 0
+    cur.execute('SELECT COUNT(DISTINCT user_id) FROM daily_authors WHERE day BETWEEN ? AND ?', (date_from, date_to))
+    authors = cur.fetchone()[0]
+    cur.execute('''SELECT MAX(user_sn), SUM(retweets) AS n FROM daily_authors WHERE day BETWEEN ? AND ?
+                GROUP BY user_id ORDER BY n DESC LIMIT ?''', (date_from, date_to, top))
+    top_authors = cur.fetchall()
+
+    return retweets, authors, top_authors
+
+
+def run_report(cur, kind, date_from, date_to, top=10):
+    """ Execute one of REPORTS between two dates inclusive and return its column names.
+        Rows are left in the cursor to be fetched as they are needed
+    """
+
+    columns, query = REPORTS[kind]
+    cur.execute(query, {'date_from': str(date_from), 'date_to': str(date_to), 'top': top,
+                        'start_hour': int(time.mktime(date_from.timetuple())) // 3600,
+                        'end_hour': int(time.mktime((date_to + datetime.timedelta(days=1)).timetuple())) // 3600})
+
+    return columns
+
+
+def init_db(conn):
+    """ Create or upgrade the database schema
+    """
+
+    cur = conn.cursor()
+    cur.execute('PRAGMA user_version')
+    version = cur.fetchone()[0]
+
+    cur.execute('BEGIN')
+    if version < 1:
+        migrate_retweets(conn)
+
+    for statement in SCHEMA:
+        cur.execute(statement)
+    migrate_followers(cur)
+    if version < 3:
+        rebuild_rollups(cur)
+
+    cur.execute('PRAGMA user_version=%d' % SCHEMA_VERSION)
+    conn.commit()
+
+
+def is_busy(err):
+    """ Return whether a database error is caused by a lock held by another connection
+    """
+
+    return isinstance(err, sqlite3.OperationalError) and ('locked' in str(err) or 'busy' in str(err))
+
+
+class Database(object):
+    """ Owns the only writing connection to the database, in WAL mode.
+        Writes are functions of a cursor sent through a queue to the writer thread, which commits
+        requests arriving together in one transaction. Readers get their own read-only connections.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.requests = queue.Queue()
+        self.local = threading.local()
+        self.thread = None
+
+    def connect(self, read_only=False):
+        """ Open a connection to the database
+        """
+
+        if read_only:
+            conn = sqlite3.connect('file:%s?mode=ro' % urllib.request.pathname2url(os.path.abspath(self.path)),
+                                   uri=True, timeout=DB_BUSY_TIMEOUT)
+        else:
+            conn = sqlite3.connect(self.path, timeout=DB_BUSY_TIMEOUT, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+
+        return conn
+
+    def start(self):
+        """ Create or upgrade the schema and start the writer thread
+        """
+
+        conn = self.connect()
+        init_db(conn)
+        self.thread = threading.Thread(target=self.serve, args=(conn,), name='db_writer', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """ Commit pending writes and stop the writer thread
+        """
+
+        if self.thread is not None:
+            self.requests.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def serve(self, conn):
+        """ Writer thread: execute write requests and commit them in groups.
+            Backups run here too, so writes coming during a backup are committed between its steps
+            and get into the copy without restarting it.
+        """
+
+        self.stopping = False
+        backups = []
+        while not self.stopping:
+            self.process(conn, self.requests.get(), DB_COMMIT_DELAY, backups)
+            while len(backups) > 0:
+                target, future = backups.pop(0)
+                try:
+                    conn.backup(target, pages=BACKUP_PAGES,
+                                progress=lambda status, remaining, total: self.between_steps(conn, backups))
+                except Exception as err:
+                    future.set_exception(err)
+                else:
+                    future.set_result(None)
+
+        conn.close()
+
+    def between_steps(self, conn, backups):
+        """ Serve writes coming within BACKUP_PAUSE seconds between backup steps
+        """
+
+        if self.stopping:
+            return
+        try:
+            request = self.requests.get(timeout=BACKUP_PAUSE)
+        except queue.Empty:
+            return
+        self.process(conn, request, 0, backups)
+
+    def process(self, conn, request, delay, backups):
+        """ Commit the request together with the ones queued after it or within `delay` seconds.
+            Backup requests are put aside to `backups`
+        """
+
+        batch = [request]
+        deadline = time.monotonic() + delay
+        while len(batch) < DB_COMMIT_BATCH:
+            try:
+                batch.append(self.requests.get(timeout=max(deadline - time.monotonic(), 0)))
+            except queue.Empty:
+                break
+
+        writes = []
+        for request in batch:
+            if request is None:
+                self.stopping = True
+            elif isinstance(request[0], sqlite3.Connection):
+                backups.append(request)
+            else:
+                writes.append(request)
+        if len(writes) == 0:
+            return
+
+        # A failed transaction fails its writes only: the writer keeps serving the next ones
+        attempt = 0
+        while True:
+            try:
+                results = self.transaction(conn, writes)
+                break
+            except Exception as err:
+                try:
+                    conn.rollback()
+                except Exception:
+                    pass
+                metrics.inc('bot_db_errors_total')
+                if is_busy(err) and attempt < DB_BUSY_RETRIES:
+                    attempt += 1
+                    logger.warning('Database is locked. Retrying in %d seconds (attempt %d of %d)'
+                                   % (2 ** attempt, attempt, DB_BUSY_RETRIES))
+                    time.sleep(2 ** attempt)
+                    continue
+                logger.error('Can\'t commit %d write(s) to database' % len(writes))
+                logger.error('Exception details: {}'.format(err))
+                results = [(future, None, err) for func, future in writes]
+                break
+
+        for future, result, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def transaction(self, conn, writes):
+        """ Execute writes in one transaction and commit it. Return [(future, result, error), ...]
+        """
+
+        # Every request runs in its own savepoint, so a failed one doesn't roll back the others
+        cur = conn.cursor()
+        cur.execute('BEGIN IMMEDIATE')
+        results = []
+        for func, future in writes:
+            cur.execute('SAVEPOINT request')
+            try:
+                result = func(cur)
+            except Exception as err:
+                cur.execute('ROLLBACK TO request')
+                results.append((future, None, err))
+            else:
+                results.append((future, result, None))
+            cur.execute('RELEASE request')
+        with metrics.timer('bot_db_commit_seconds'):
+            conn.commit()
+
+        return results
+
+    def write(self, func):
+        """ Execute func(cursor) in the writer thread and return its result once it is committed
+        """
+
+        future = concurrent.futures.Future()
+        self.requests.put((func, future))
+
+        return future.result()
+
+    def backup(self, target):
+        """ Copy the database to the target connection in the writer thread, BACKUP_PAGES pages at a time
+        """
+
+        future = concurrent.futures.Future()
+        self.requests.put((target, future))
+
+        return future.result()
+
+    def reader(self):
+        """ Return a read-only connection of the current thread
+        """
+
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.connect(read_only=True)
+            self.local.conn = conn
+
+        return conn
+
+
+def backup_name(db_file):
+    """ Return the name ending of compressed backups of the database file
+    """
+
+    return '-%s.gz' % os.path.basename(db_file)
+
+
+def list_backups(db_file, backup_dir):
+    """ Return paths of compressed backups of the database file from the oldest to the newest one
+    """
+
+    if not os.path.isdir(backup_dir):
+        return []
+
+    ending = backup_name(db_file)
+
+    return [os.path.join(backup_dir, x) for x in sorted(os.listdir(backup_dir)) if x.endswith(ending)]
+
+
+def backup_database(db_file, backup_dir, db=None):
+    """ Copy the database with the online backup API. If the running Database is given, the copy is made
+        by its writer in steps, serving writes between them. The copy is gzipped to backup_dir and only
+        BACKUP_KEEP newest backups are kept. Return the path of the backup
+    """
+
+    if not os.path.isdir(backup_dir):
+        os.makedirs(backup_dir)
+
+    file_postfix = datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
+    path = os.path.join(backup_dir, file_postfix + backup_name(db_file))
+    tmp_db = path[:-len('.gz')] + '.tmp'
+    tmp_gz = path + '.tmp'
+
+    logger.info('Backing up database to %s...' % path)
+    try:
+        dst = sqlite3.connect(tmp_db, check_same_thread=False)
+        try:
+            if db is not None:
+                db.backup(dst)
+            else:
+                # Without the writer at hand the database is copied in one step. Being a reader in WAL mode,
+                # it doesn't stall writers of other processes, which would restart a backup made in steps
+                src = Database(db_file).connect(read_only=True)
+                try:
+                    src.backup(dst)
+                finally:
+                    src.close()
+        finally:
+            dst.close()
+
+        with open(tmp_db, 'rb') as db_copy, gzip.open(tmp_gz, 'wb') as backup_file:
+            shutil.copyfileobj(db_copy, backup_file)
+        os.replace(tmp_gz, path)
+    finally:
+        for tmp_file in (tmp_db, tmp_gz):
+            if os.path.isfile(tmp_file):
+                os.remove(tmp_file)
+    logger.info('Done')
+
+    for old_path in list_backups(db_file, backup_dir)[:-BACKUP_KEEP]:
+        logger.info('Removing old backup %s' % old_path)
+        os.remove(old_path)
+
+    return path
+
+
+class TBackup(object):
+    """ This job backs up the database every BACKUP_INTERVAL seconds, counting from the newest backup
+    """
+
+    def __init__(self, name, db, backup_dir):
+        self.name = name
+        self.db = db
+        self.backup_dir = backup_dir
+
+    def step(self):
+        backups = list_backups(self.db.path, self.backup_dir)
+        if len(backups) > 0:
+            due = os.path.getmtime(backups[-1]) + BACKUP_INTERVAL - time.time()
+            if due > 0:
+                return due
+
+        with metrics.timer('bot_backup_seconds'):
+            backup_database(self.db.path, self.backup_dir, self.db)
 
-def read_offset():
-    """ Read status offset from file if exists
+        return BACKUP_INTERVAL
+
+
+def read_offset(cur, path=OFFSET_FILE):
+    """ Read status offset from database or, if it isn't there yet, from file if exists
     """
 
     offset_id = None
 
-    if os.path.isfile(OFFSET_FILE):
+    cur.execute('SELECT value FROM state WHERE key=\'offset\'')
+    row = cur.fetchone()
+    if row is not None and row[0] > 0:
+        logger.info('Offset found in database. We will use it')
+        offset_id = row[0]
+    elif os.path.isfile(path):
         logger.info('Offset file found. Try to read an offset...')
-        with open(OFFSET_FILE, 'r') as offset_file:
+        with open(path, 'r') as offset_file:
             st = int(offset_file.readline())
             if st > 0:
                 logger.info('Offset from the file seems valid. We will use it')
@@ -37,14 +590,100 @@ def read_offset():
     return offset_id
 
 
-def write_offset(offset):
-    """ Write an offset to file
+def write_offset(cur, offset, key='offset'):
+    """ Store an offset in database. It is committed together with the rest of the transaction
+    """
+
+    cur.execute('INSERT OR REPLACE INTO state VALUES (?,?)', (key, offset))
+
+
+def advance_offset(cur, offset, key='offset'):
+    """ Store an offset in database unless a greater one is stored already. Return the stored offset
     """
 
-    with open(OFFSET_FILE, 'w') as offset_file:
+    cur.execute('INSERT OR REPLACE INTO state VALUES (?, MAX(?, COALESCE((SELECT value FROM state WHERE key=?), 0)))',
+                (key, offset, key))
+    cur.execute('SELECT value FROM state WHERE key=?', (key,))
+
+    return cur.fetchone()[0]
+
+
+def write_offset_file(offset, path=OFFSET_FILE):
+    """ Write an offset to file atomically: to a temporary file first, then rename it.
+        The temporary file is per process, so bot instances sharing the directory don't mix their writes
+    """
+
+    tmp_file = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_file, 'w') as offset_file:
         offset_file.write(str(offset) + '\n')
         offset_file.flush()
         os.fsync(offset_file.fileno())
+    os.replace(tmp_file, path)
+
+
+def iter_timeline(api, user_id, count=100):
+    """ Yield pages of the user's timeline from the newest statuses to the oldest ones
+    """
+
+    max_id = None
+    while True:
+        page = twitter_retry.call('Loading timeline',
+                                  lambda: api.GetUserTimeline(user_id=user_id, max_id=max_id, count=count),
+                                  api, '/statuses/user_timeline')
+        if len(page) > 0:
+            yield page
+        if len(page) < count:
+            break
+        max_id = page[-1].id - 1
+
+
+def shard_query(words):
+    """ Split words into search queries which fit into SEARCH_QUERY_MAX_LENGTH characters
+        and SEARCH_QUERY_MAX_OPERATORS OR operators
+    """
+
+    queries = []
+    current = []
+    for word in words:
+        candidate = current + [word]
+        if len(current) > 0 and (len(' OR '.join(candidate)) > SEARCH_QUERY_MAX_LENGTH
+                                 or len(candidate) - 1 > SEARCH_QUERY_MAX_OPERATORS):
+            queries.append(' OR '.join(current))
+            candidate = [word]
+        current = candidate
+    if len(current) > 0:
+        queries.append(' OR '.join(current))
+
+    return queries
+
+
+def iter_search(api, query, since_id, count=100, calls=None):
+    """ Yield all tweets newer than since_id from the oldest one to the newest one.
+        Search result pages are walked backwards with max_id, so a burst of tweets
+        which doesn't fit on one page is drained completely.
+        API calls made are counted in calls[query] if a Counter is given.
+    """
+
+    found = {}
+    max_id = None
+    while True:
+        page = twitter_retry.call('Searching for tweets',
+                                  lambda: api.GetSearch(term=query, since_id=since_id, max_id=max_id, count=count,
+                                                        result_type='recent'),
+                                  api, '/search/tweets')
+        if calls is not None:
+            calls[query] += 1
+        for status in page:
+            found[status.id] = status
+        # Search often returns short pages while older tweets are left, only an empty one ends the walk
+        if len(page) == 0:
+            break
+        max_id = min(x.id for x in page) - 1
+        if since_id is not None and max_id <= since_id:
+            break
+
+    for status_id in sorted(found):
+        yield found[status_id]
 
 
 def read_and_prepare(filename):
@@ -65,511 +704,2063 @@ def read_and_prepare(filename):
     return result
 
 
-def log_tweet(res, reason):
-    """ Log interesting tweets
+class WordMatcher(object):
+    """ Aho-Corasick automaton over the blacklisted phrases.
+        Finds the first blacklisted phrase in a text in a single pass, whatever the number of phrases.
     """
 
-    if reason == 'already_retweeted':
-        logger.info('\t[Skipping retweet by %s (%d)]' % (res.user.screen_name, res.user.id))
-        logger.info('\t[Reason: already retweeted]')
-        logger.info('\t[Original tweet data:]')
-        logger.info('\t[Created: %s UTC]' % str(res.retweeted_status.created_at))
-        logger.info('\t[User ID: %d]' % res.retweeted_status.user.id)
-        logger.info('\t[User SN: %s]' % res.retweeted_status.user.screen_name)
-        logger.info('\t[User Name: %s]' % res.retweeted_status.user.name)
-        logger.info('\t[Tweet ID: %d]' % res.retweeted_status.id)
-        logger.info('\t[Text: %s]' % res.retweeted_status.text)
+    def __init__(self, words, ignore_case=False, normalization=None):
+        self.words = list(words)
+        self.ignore_case = ignore_case
+        self.normalization = normalization
+
+        # Trie transitions, failure links and a matched phrase (if any) for every state
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [None]
+
+        for word in self.words:
+            key = self.prepare(word)
+            if key == '':
+                continue
+            state = 0
+            for ch in key:
+                nxt = self.goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto[state][ch] = nxt
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append(None)
+                state = nxt
+            if self.out[state] is None:
+                self.out[state] = word
+
+        # Breadth-first pass to build failure links. A state inherits the phrase of its failure state
+        # so that a phrase which is a suffix of a longer path is still reported.
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for ch, nxt in self.goto[state].items():
+                queue.append(nxt)
+                f = self.fail[state]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(ch, 0)
+                if self.out[nxt] is None:
+                    self.out[nxt] = self.out[self.fail[nxt]]
+
+    def prepare(self, text):
+        """ Bring a phrase or a text to the form used for matching
+        """
+
+        if self.normalization:
+            text = unicodedata.normalize(self.normalization, text)
+        if self.ignore_case:
+            text = text.casefold()
+
+        return text
+
+    def search(self, text):
+        """ Return the first blacklisted phrase found in the text or None
+        """
+
+        if len(self.goto) == 1:
+            return None
+
+        goto = self.goto
+        fail = self.fail
+        out = self.out
+        state = 0
+        for ch in self.prepare(text):
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state] is not None:
+                return out[state]
+
+        return None
+
+
+class BlacklistCache(object):
+    """ Keeps blacklisted users and the blacklisted phrases matcher in memory.
+        Files are re-read only when their mtime, size or inode changes, so they still may be edited online.
+    """
 
-        return True
-    elif reason == 'blacklisted_user':
-        logger.info('\t[Skipping retweet by %s (%d)]' % (res.user.screen_name, res.user.id))
-        logger.info('\t[Reason: user is in blacklist]')
-        logger.info('\t[Original tweet data:]')
-        logger.info('\t[Created: %s UTC]' % str(res.created_at))
-        logger.info('\t[User ID: %d]' % res.user.id)
-        logger.info('\t[User SN: %s]' % res.user.screen_name)
-        logger.info('\t[User Name: %s]' % res.user.name)
-        logger.info('\t[Tweet ID: %d]' % res.id)
-        logger.info('\t[Text: %s]' % res.text)
+    def __init__(self, users_file, words_file):
+        self.users_file = users_file
+        self.words_file = words_file
+        self.users_stat = None
+        self.words_stat = None
+        self.users = set()
+        self.matcher = WordMatcher([], BLACKLIST_IGNORE_CASE, BLACKLIST_NORMALIZATION)
 
-        return True
-    elif reason == 'blacklisted_word':
-        logger.info('\t[Skipping retweet by %s (%d)]' % (res.user.screen_name, res.user.id))
-        logger.info('\t[Reason: tweet contains blacklisted phrases]')
-        logger.info('\t[Original tweet data:]')
-        logger.info('\t[Created: %s UTC]' % str(res.created_at))
-        logger.info('\t[User ID: %d]' % res.user.id)
-        logger.info('\t[User SN: %s]' % res.user.screen_name)
-        logger.info('\t[User Name: %s]' % res.user.name)
-        logger.info('\t[Tweet ID: %d]' % res.id)
-        logger.info('\t[Text: %s]' % res.text)
+    @staticmethod
+    def file_signature(filename):
+        """ Return (mtime, size, inode) of the file or None if it doesn't exist
+        """
 
-        return True
-    elif reason == 'valid_tweet':
-        logger.info('\tCreated: %s UTC' % str(res.created_at))
-        logger.info('\tUser ID: %d' % res.user.id)
-        logger.info('\tUser SN: %s' % res.user.screen_name)
-        logger.info('\tUser Name: %s' % res.user.name)
-        logger.info('\tTweet ID: %d' % res.id)
-        logger.info('\tText: %s' % res.text)
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+
+        return st.st_mtime_ns, st.st_size, st.st_ino
+
+    def refresh(self):
+        """ Reload blacklists which have been changed since the last call
+        """
+
+        users_stat = self.file_signature(self.users_file)
+        if users_stat != self.users_stat:
+            self.users = set(read_and_prepare(self.users_file))
+            self.users_stat = users_stat
+            logger.info('Users blacklist loaded: %d item(s)' % len(self.users))
+
+        words_stat = self.file_signature(self.words_file)
+        if words_stat != self.words_stat:
+            self.matcher = WordMatcher(read_and_prepare(self.words_file),
+                                       BLACKLIST_IGNORE_CASE, BLACKLIST_NORMALIZATION)
+            self.words_stat = words_stat
+            logger.info('Words blacklist loaded: %d item(s)' % len(self.matcher.words))
+
+    def is_user_blacklisted(self, user):
+        """ Check whether the user's id or screen name is blacklisted
+        """
+
+        return str(user.id) in self.users or user.screen_name in self.users
+
+    def search_phrase(self, text):
+        """ Return the first blacklisted phrase found in the text or None
+        """
+
+        return self.matcher.search(text)
+
+
+class SeenIndex(object):
+    """ Bounded set of recently handled tweet ids. When it is full, the least recently added ids are forgotten
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.ids = collections.OrderedDict()
+
+    def __contains__(self, tweet_id):
+        return tweet_id in self.ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, tweet_id):
+        """ Remember a tweet id
+        """
+
+        self.ids[tweet_id] = None
+        self.ids.move_to_end(tweet_id)
+        while len(self.ids) > self.size:
+            self.ids.popitem(last=False)
+
+    def seed(self, cur):
+        """ Remember the latest retweeted and queued tweets from database
+        """
+
+        cur.execute('SELECT tweet_id FROM retweets ORDER BY retweeted DESC LIMIT ?', (self.size,))
+        for row in reversed(cur.fetchall()):
+            self.add(row[0])
+        cur.execute('SELECT tweet_id FROM outbox')
+        for row in cur.fetchall():
+            self.add(row[0])
+
+
+class TokenBucket(object):
+    """ Token bucket rate limiter: `rate` tokens per second, up to `capacity` tokens saved for bursts
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def consume(self):
+        """ Take a token if there is one. Return whether it was taken
+        """
+
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
 
-        return True
-    else:
         return False
 
+    def wait_time(self):
+        """ Return how many seconds are left until a token is available
+        """
+
+        tokens = self.tokens + (time.monotonic() - self.updated) * self.rate
 
-class TWatcher(threading.Thread):
-    """ This thread searches for tweets containing certain keywords every CHECK_INTERVAL seconds
+        return max((1 - tokens) / self.rate, 0)
+
+
+class Stopped(Exception):
+    """ Raised inside a job when the bot is stopping
+    """
+
+
+def wait(seconds):
+    """ Sleep which is interrupted when the bot is stopping
     """
 
-    def __init__(self, name, api):
-        super(TWatcher, self).__init__()
+    if stop_event.wait(max(seconds, 0)):
+        raise Stopped()
+
+
+def get_rate_limit(api, resource):
+    """ Return (remaining calls, reset time) known for a Twitter API resource like '/search/tweets'
+        or None if there is no information
+    """
+
+    rate_limit = getattr(api, 'rate_limit', None)
+    if rate_limit is None:
+        return None
+
+    try:
+        limit = rate_limit.get_limit(resource)
+    except Exception:
+        return None
+
+    if not limit.reset:
+        return None
+
+    return limit.remaining, limit.reset
+
+
+class RetryPolicy(object):
+    """ Calls a function until it succeeds, sleeping between attempts with exponential backoff and jitter.
+        Rate limit errors wait for the limit reset. After BREAKER_THRESHOLD failures in a row the circuit opens:
+        every thread using the policy holds its calls for BREAKER_TIMEOUT seconds, then one of them probes
+        the service while the others keep waiting until the probe succeeds.
+    """
+
+    def __init__(self, name):
         self.name = name
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.open_until = 0
+        self.probing = False
+
+    def delay(self, err, api=None, resource=None):
+        """ Return how long to wait after the error
+        """
+
+        if isinstance(err, urllib.error.HTTPError) and err.code in (429, 503):
+            retry_after = err.headers.get('Retry-After', '')
+            if retry_after.isdigit():
+                return int(retry_after)
+        elif TWITTER_RATE_LIMIT_EXCEEDED in twitter_error_codes(err) and resource is not None:
+            limit = get_rate_limit(api, resource)
+            if limit is not None:
+                return max(limit[1] - time.time(), 0) + 1
+
+        backoff = min(SLEEP_ERROR_INTERVAL * 2 ** (self.failures - 1), BACKOFF_MAX_INTERVAL)
+        return random.uniform(backoff / 2, backoff)
+
+    def admit(self):
+        """ Wait until the circuit lets a call through
+        """
+
+        while True:
+            with self.lock:
+                if self.failures < BREAKER_THRESHOLD:
+                    return
+                suspended = self.open_until - time.time()
+                if suspended <= 0 and not self.probing:
+                    self.probing = True
+                    return
+
+            if suspended > 0:
+                logger.warning('%s: too many errors, calls are suspended for %d seconds' % (self.name, suspended))
+                wait(suspended)
+            else:
+                # Another thread is probing the service
+                wait(1)
+
+    def succeeded(self):
+        """ Close the circuit after a successful call
+        """
+
+        with self.lock:
+            self.failures = 0
+            self.open_until = 0
+            self.probing = False
+
+    def failed(self, err, api=None, resource=None):
+        """ Count a failed call, opening the circuit if there are too many of them in a row.
+            Return how long to wait before the next attempt
+        """
+
+        with self.lock:
+            self.failures += 1
+            delay = self.delay(err, api, resource)
+            if self.failures >= BREAKER_THRESHOLD:
+                self.open_until = max(self.open_until, time.time() + max(delay, BREAKER_TIMEOUT))
+            self.probing = False
+
+        return delay
+
+    def call(self, description, func, api=None, resource=None):
+        """ Call func() until it succeeds and return its result.
+            api and resource are used to look up the Twitter rate limit reset time.
+        """
+
+        while True:
+            self.admit()
+
+            started = time.monotonic()
+            try:
+                result = func()
+            except Exception as err:
+                metrics.observe('bot_api_call_seconds', time.monotonic() - started, service=self.name, call=description)
+                metrics.inc('bot_api_errors_total', service=self.name, call=description)
+                delay = self.failed(err, api, resource)
+                logger.error('%s: an error occurred. Sleep for %d seconds and try again...' % (description, delay))
+                logger.error('Exception details: {}'.format(err))
+                wait(delay)
+            else:
+                metrics.observe('bot_api_call_seconds', time.monotonic() - started, service=self.name, call=description)
+                self.succeeded()
+                return result
+
+
+# Retry policies shared by all threads working with the same service
+twitter_retry = RetryPolicy('Twitter API')
+forecast_retry = RetryPolicy('Forecast server')
+
+
+class ForecastCache(object):
+    """ Keeps parsed forecasts in memory until the feed says they are updated.
+        Expired forecasts are re-validated with a conditional request, so unchanged ones aren't downloaded again.
+    """
+
+    def __init__(self, capture=None):
+        self.entries = {}
+        self.capture = capture
+
+    @staticmethod
+    def expiry(root, headers):
+        """ Find out until when the forecast is fresh: the feed's nextupdate time or the Expires header,
+            whichever comes first
+        """
+
+        times = []
+
+        nextupdate = root.findtext('./meta/nextupdate')
+        if nextupdate:
+            try:
+                times.append(time.mktime(time.strptime(nextupdate[0:19], '%Y-%m-%dT%H:%M:%S')))
+            except ValueError:
+                pass
+
+        expires = headers.get('Expires')
+        if expires:
+            try:
+                times.append(email.utils.parsedate_to_datetime(expires).timestamp())
+            except (TypeError, ValueError):
+                pass
+
+        if len(times) == 0:
+            return time.time() + FORECAST_CACHE_TTL
+
+        return min(times)
+
+    def get(self, url):
+        """ Return the root element of the forecast from the url
+        """
+
+        entry = self.entries.get(url)
+        if entry is not None and time.time() < entry['expires']:
+            logger.info('Forecast is still fresh. Using cached data')
+            return entry['root']
+
+        request = urllib.request.Request(url)
+        if entry is not None:
+            if entry['etag']:
+                request.add_header('If-None-Match', entry['etag'])
+            if entry['modified']:
+                request.add_header('If-Modified-Since', entry['modified'])
+
+        try:
+            response = urllib.request.urlopen(request, timeout=HTTP_TIMEOUT)
+        except urllib.error.HTTPError as err:
+            if err.code != 304 or entry is None:
+                raise
+            logger.info('Forecast is not modified. Using cached data')
+            entry['expires'] = self.expiry(entry['root'], err.headers)
+            return entry['root']
+
+        with response:
+            body = response.read()
+            root = ET.fromstring(body)
+            if self.capture is not None:
+                self.capture.write('forecast', {'url': url}, body.decode('utf-8'))
+            self.entries[url] = {'root': root,
+                                 'etag': response.headers.get('ETag'),
+                                 'modified': response.headers.get('Last-Modified'),
+                                 'expires': self.expiry(root, response.headers)}
+
+        return root
+
+
+class Capture(object):
+    """ Gzipped JSON lines file of API responses: call name, arguments, result and the time it came
+    """
+
+    # Interval in seconds to flush the file, so a crash loses only the last records
+    FLUSH_INTERVAL = 10
+
+    def __init__(self, path):
+        self.file = gzip.open(path, 'at', encoding='utf-8')
+        self.lock = threading.Lock()
+        self.flushed = time.monotonic()
+
+    def write(self, call, kwargs, result):
+        line = json.dumps({'time': time.time(), 'call': call, 'kwargs': kwargs, 'result': result}, ensure_ascii=False)
+        with self.lock:
+            self.file.write(line + '\n')
+            if time.monotonic() - self.flushed >= self.FLUSH_INTERVAL:
+                self.file.flush()
+                self.flushed = time.monotonic()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def read_capture(path):
+    """ Yield records of a capture file. A capture cut off by a crash is read up to the damaged record
+    """
+
+    with gzip.open(path, 'rt', encoding='utf-8') as capture_file:
+        try:
+            for line in capture_file:
+                yield json.loads(line)
+        except (EOFError, ValueError):
+            logger.warning('Capture %s is cut off. The rest of it is skipped' % path)
+
+
+class RecordingApi(object):
+    """ Passes calls to the Twitter API and records responses of the reading ones to a capture
+    """
+
+    def __init__(self, api, capture):
+        self.api = api
+        self.capture = capture
+
+    def __getattr__(self, name):
+        return getattr(self.api, name)
+
+    def GetSearch(self, **kwargs):
+        result = self.api.GetSearch(**kwargs)
+        self.capture.write('GetSearch', kwargs, [x.AsDict() for x in result])
+        return result
+
+    def GetUserTimeline(self, **kwargs):
+        result = self.api.GetUserTimeline(**kwargs)
+        self.capture.write('GetUserTimeline', kwargs, [x.AsDict() for x in result])
+        return result
+
+    def GetFollowerIDs(self, **kwargs):
+        result = self.api.GetFollowerIDs(**kwargs)
+        self.capture.write('GetFollowerIDs', kwargs, result)
+        return result
+
+
+class ReplayApi(object):
+    """ Plays a capture back in place of the Twitter API. Searches see the recorded tweets as they were coming:
+        at the recorded pace multiplied by speed or, if speed is 0, one recorded search per new search.
+        Pages of one search, walked with max_id, are released together as the search was made.
+        Posting is only logged. decode_status turns a recorded status dict back to a status object.
+    """
+
+    rate_limit = None
+
+    def __init__(self, path, decode_status, speed=1):
+        self.speed = speed
+        self.searches = []
+        self.calls = collections.defaultdict(list)
+        self.forecasts = collections.defaultdict(list)
+
+        # The last search of every query. Its next pages are the records of the query with max_id
+        last_searches = {}
+        for record in read_capture(path):
+            call = record['call']
+            if call == 'GetSearch':
+                term = record['kwargs'].get('term')
+                if record['kwargs'].get('max_id') is None or term not in last_searches:
+                    last_searches[term] = (record['time'], [])
+                    self.searches.append(last_searches[term])
+                last_searches[term][1].extend(decode_status(x) for x in record['result'])
+            elif call == 'GetUserTimeline':
+                self.calls[call, record['kwargs'].get('max_id')].append([decode_status(x)
+                                                                         for x in record['result']])
+            elif call == 'GetFollowerIDs':
+                self.calls[call, None].append(record['result'])
+            elif call == 'forecast':
+                self.forecasts[record['kwargs']['url']].append(record['result'])
+        self.searches.sort(key=lambda x: x[0])
+
+        self.lock = threading.Lock()
+        self.started = None
+        self.released = 0
+        self.tweet_ids = []
+        self.tweets = {}
+        self.newest_served = 0
+        self.retweeted = []
+        self.posted = []
+
+    def first_id(self):
+        """ Return the id of the oldest recorded tweet or None if there are no tweets
+        """
+
+        ids = [x.id for _, statuses in self.searches for x in statuses]
+
+        return min(ids) if len(ids) > 0 else None
+
+    def release(self):
+        """ Make tweets of the recorded searches which time has come visible to searches
+        """
+
+        if self.speed:
+            now = self.searches[0][0] + (time.monotonic() - self.started) * self.speed
+            end = self.released
+            while end < len(self.searches) and self.searches[end][0] <= now:
+                end += 1
+        else:
+            end = min(self.released + 1, len(self.searches))
+
+        for _, statuses in self.searches[self.released:end]:
+            for status in statuses:
+                if status.id not in self.tweets:
+                    bisect.insort(self.tweet_ids, status.id)
+                self.tweets[status.id] = status
+        self.released = end
+
+    def finished(self):
+        """ Check whether every recorded tweet is released and found
+        """
+
+        with self.lock:
+            return self.released == len(self.searches) and (len(self.tweet_ids) == 0 or
+                                                            self.newest_served >= self.tweet_ids[-1])
+
+    def GetSearch(self, term=None, since_id=None, max_id=None, count=15, **kwargs):
+        with self.lock:
+            if self.started is None:
+                self.started = time.monotonic()
+            if max_id is None and len(self.searches) > 0:
+                self.release()
+
+            low = bisect.bisect_right(self.tweet_ids, since_id) if since_id else 0
+            high = bisect.bisect_right(self.tweet_ids, max_id) if max_id else len(self.tweet_ids)
+            ids = self.tweet_ids[max(low, high - count):high]
+            if len(ids) > 0:
+                self.newest_served = max(self.newest_served, ids[-1])
+            elif max_id is None:
+                self.newest_served = max([self.newest_served] + self.tweet_ids[-1:])
+
+            return [self.tweets[x] for x in reversed(ids)]
+
+    def recorded(self, call, key=None):
+        """ Return the next recorded result of a call. The last one is repeated
+        """
+
+        with self.lock:
+            results = self.calls.get((call, key))
+            if not results:
+                raise KeyError('There is no recorded %s response' % call)
+            return results.pop(0) if len(results) > 1 else results[0]
+
+    def GetUserTimeline(self, user_id=None, max_id=None, count=20, **kwargs):
+        return self.recorded('GetUserTimeline', max_id)
+
+    def GetFollowerIDs(self, user_id=None, **kwargs):
+        return self.recorded('GetFollowerIDs')
+
+    def PostRetweet(self, status_id, **kwargs):
+        logger.info('Replay: retweet of %d is not sent' % status_id)
+        with self.lock:
+            self.retweeted.append(status_id)
+
+    def PostUpdate(self, status, **kwargs):
+        logger.info('Replay: tweet is not sent')
+        with self.lock:
+            self.posted.append(status)
+
+
+class ReplayForecasts(object):
+    """ Gives recorded forecasts in place of ForecastCache. The last one is repeated
+    """
+
+    def __init__(self, replay):
+        self.replay = replay
+
+    def get(self, url):
+        bodies = self.replay.forecasts.get(url)
+        if not bodies:
+            raise KeyError('There is no recorded forecast from %s' % url)
+
+        return ET.fromstring((bodies.pop(0) if len(bodies) > 1 else bodies[0]).encode('utf-8'))
+
+
+class AdaptivePoll(object):
+    """ Search interval that shortens while new tweets keep coming and lengthens when it is quiet,
+        but never spends the search quota faster than it is restored, whatever number of calls a search takes
+    """
+
+    def __init__(self, api, resource, interval=CHECK_INTERVAL, interval_min=CHECK_INTERVAL_MIN,
+                 interval_max=CHECK_INTERVAL_MAX):
         self.api = api
+        self.resource = resource
+        self.interval = interval
+        self.interval_min = interval_min
+        self.interval_max = interval_max
+
+    def update(self, results_count, calls=1):
+        """ Compute the interval before the next search after one that found results_count tweets
+            making `calls` API calls
+        """
+
+        if results_count > 0:
+            self.interval = max(self.interval / 2, self.interval_min)
+        else:
+            self.interval = min(self.interval * 1.5, self.interval_max)
+
+        limit = get_rate_limit(self.api, self.resource)
+        if limit is not None:
+            remaining, reset = limit
+            self.interval = max(self.interval, (reset - time.time()) / max(remaining, 1) * max(calls, 1))
+
+        return self.interval
+
+
+def twitter_error_codes(err):
+    """ Extract Twitter API error codes from an exception
+    """
+
+    codes = set()
+    for arg in err.args:
+        items = arg if isinstance(arg, list) else [arg]
+        for item in items:
+            if isinstance(item, dict) and 'code' in item:
+                codes.add(item['code'])
+
+    return codes
+
+
+def pack_ids(ids):
+    """ Pack a sorted list of ids into a BLOB: differences between neighbours as varints
+    """
+
+    result = bytearray()
+    prev = 0
+    for x in ids:
+        delta = x - prev
+        prev = x
+        while delta >= 0x80:
+            result.append((delta & 0x7f) | 0x80)
+            delta >>= 7
+        result.append(delta)
+
+    return bytes(result)
+
+
+def unpack_ids(blob):
+    """ Unpack ids packed by pack_ids
+    """
+
+    ids = []
+    prev = 0
+    delta = 0
+    shift = 0
+    for b in blob:
+        delta |= (b & 0x7f) << shift
+        if b & 0x80:
+            shift += 7
+        else:
+            prev += delta
+            ids.append(prev)
+            delta = 0
+            shift = 0
+
+    return ids
+
+
+def diff_sorted(old, new):
+    """ Compare two sorted lists of ids in one pass. Return (added, removed)
+    """
+
+    added = []
+    removed = []
+    i = 0
+    j = 0
+    while i < len(old) and j < len(new):
+        if old[i] == new[j]:
+            i += 1
+            j += 1
+        elif old[i] < new[j]:
+            removed.append(old[i])
+            i += 1
+        else:
+            added.append(new[j])
+            j += 1
+    removed.extend(old[i:])
+    added.extend(new[j:])
+
+    return added, removed
+
+
+def migrate_followers(cur):
+    """ Convert followers lists saved as comma-joined text in the old 'stats' table to snapshots
+    """
+
+    cur.execute('SELECT name FROM sqlite_master WHERE type=\'table\' AND name=\'stats\'')
+    if cur.fetchone() is None:
+        return
+
+    cur.execute('SELECT date, followers FROM stats WHERE date NOT IN (SELECT date FROM follower_snapshots)')
+    rows = cur.fetchall()
+    for date, followers in rows:
+        ids = sorted(int(x) for x in followers.split(',') if x != '')
+        cur.execute('INSERT INTO follower_snapshots VALUES (?,?,?)', (date, len(ids), pack_ids(ids)))
+    if len(rows) > 0:
+        logger.info('Converted %d followers list(s) to snapshots' % len(rows))
+
+
+def follower_churn(cur, date_from, date_to):
+    """ Return how many followers joined and left between two dates inclusive
+    """
+
+    cur.execute('SELECT joined, COUNT(*) FROM follower_events WHERE date BETWEEN ? AND ? GROUP BY joined',
+                (str(date_from), str(date_to)))
+    counts = dict(cur.fetchall())
+
+    return counts.get(1, 0), counts.get(0, 0)
+
+
+class JsonFormatter(logging.Formatter):
+    """ Formats a record as a JSON line. Fields passed as extra={'fields': {...}} are added to it
+    """
+
+    def format(self, record):
+        line = {'time': round(record.created, 3), 'level': record.levelname, 'message': record.getMessage()}
+        line.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            line['exception'] = self.formatException(record.exc_info)
+
+        return json.dumps(line, ensure_ascii=False)
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """ Puts records to the queue as they are, so messages are formatted by the listener thread.
+        Records must not be changed after logging, which holds for the bot's own ones
+    """
+
+    def prepare(self, record):
+        return record
+
+
+def start_log_queues(*names):
+    """ Move handlers of the loggers to background threads, so file writes happen off the jobs' threads.
+        Return the listeners to be stopped on exit
+    """
+
+    listeners = []
+    for name in names:
+        log = logging.getLogger(name)
+        log_queue = queue.Queue()
+        listener = logging.handlers.QueueListener(log_queue, *log.handlers, respect_handler_level=True)
+        log.handlers = [LogQueueHandler(log_queue)]
+        metrics.register('bot_log_queue_depth', log_queue.qsize, logger=name)
+        listener.start()
+        listeners.append(listener)
+
+    return listeners
+
+
+def log_tweet(res, reason, phrase=None):
+    """ Log a decision made about a found tweet as one structured record
+    """
+
+    metrics.inc('bot_tweets_total', reason=reason)
+    if not decision_logger.isEnabledFor(logging.INFO):
+        return
+
+    fields = {
+        'reason': reason,
+        'tweet_id': res.id,
+        'user_id': res.user.id,
+        'user_sn': res.user.screen_name,
+        'latency': round(time.time() - res.created_at_in_seconds, 3),
+    }
+    if reason == 'already_retweeted':
+        fields['original_id'] = res.retweeted_status.id
+        fields['original_user_id'] = res.retweeted_status.user.id
+    if phrase is not None:
+        fields['phrase'] = phrase
+    if decision_logger.isEnabledFor(logging.DEBUG):
+        fields['text'] = res.text
+
+    decision_logger.info('%s %d', reason, res.id, extra={'fields': fields})
+
+
+class Metrics(object):
+    """ Counters, gauges and histograms of the bot's work, rendered in Prometheus text format.
+        An update only takes a lock and changes a number, so metrics are always collected.
+        Gauges may also be functions, which are called when metrics are rendered.
+    """
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = collections.defaultdict(float)
+        self.gauges = {}
+        self.histograms = {}
+        self.functions = {}
+
+    @staticmethod
+    def key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        """ Increase a counter
+        """
+
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] += value
+
+    def set(self, name, value, **labels):
+        """ Set a gauge
+        """
+
+        key = self.key(name, labels)
+        with self.lock:
+            self.gauges[key] = value
+
+    def register(self, name, func, **labels):
+        """ Make func() the value of a gauge
+        """
+
+        key = self.key(name, labels)
+        with self.lock:
+            self.functions[key] = func
+
+    def observe(self, name, value, **labels):
+        """ Add a value to a histogram
+        """
+
+        key = self.key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {'buckets': [0] * (len(self.BUCKETS) + 1), 'sum': 0, 'count': 0}
+            histogram['buckets'][bisect.bisect_left(self.BUCKETS, value)] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """ Observe the time spent in the with-block
+        """
+
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - started, **labels)
+
+    @staticmethod
+    def format_sample(name, labels, value):
+        if len(labels) > 0:
+            name += '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')
+                                                   .replace('\n', '\\n')) for k, v in labels)
+        return '%s %s' % (name, repr(float(value)))
+
+    def counter(self, name):
+        """ Return {labels: value} of a counter
+        """
+
+        with self.lock:
+            return {labels: value for (key, labels), value in self.counters.items() if key == name}
+
+    def render(self):
+        """ Return all metrics in Prometheus text format
+        """
+
+        with self.lock:
+            counters = list(self.counters.items())
+            gauges = dict(self.gauges)
+            functions = list(self.functions.items())
+            histograms = [(key, dict(x, buckets=list(x['buckets']))) for key, x in self.histograms.items()]
+
+        for key, func in functions:
+            try:
+                gauges[key] = func()
+            except Exception as err:
+                logger.warning('Can\'t get metric %s: %s' % (key[0], err))
+
+        families = collections.OrderedDict()
+        for (name, labels), value in sorted(counters):
+            families.setdefault((name, 'counter'), []).append(self.format_sample(name, labels, value))
+        for (name, labels), value in sorted(gauges.items()):
+            families.setdefault((name, 'gauge'), []).append(self.format_sample(name, labels, value))
+        for (name, labels), histogram in sorted(histograms, key=lambda x: x[0]):
+            samples = families.setdefault((name, 'histogram'), [])
+            count = 0
+            for bound, bucket in zip(self.BUCKETS + ('+Inf',), histogram['buckets']):
+                count += bucket
+                samples.append(self.format_sample(name + '_bucket', labels + (('le', bound),), count))
+            samples.append(self.format_sample(name + '_sum', labels, histogram['sum']))
+            samples.append(self.format_sample(name + '_count', labels, histogram['count']))
+
+        lines = []
+        for (name, kind), samples in families.items():
+            lines.append('# TYPE %s %s' % (name, kind))
+            lines.extend(samples)
+
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+class MetricsServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """ Serves metrics at /metrics
+    """
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+
+        body = metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(host, port):
+    """ Serve metrics over HTTP in a background thread. Return the server to shut it down
+    """
+
+    server = MetricsServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logger.info('Metrics are served at http://%s:%d/metrics' % (host, port))
+
+    return server
+
+
+class TMetricsWriter(object):
+    """ This job writes metrics to METRICS_FILE every METRICS_INTERVAL seconds
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def step(self):
+        tmp_file = METRICS_FILE + '.tmp'
+        with open(tmp_file, 'w') as metrics_file:
+            metrics_file.write(metrics.render())
+        os.replace(tmp_file, METRICS_FILE)
+
+        return METRICS_INTERVAL
+
+
+class Scheduler(object):
+    """ Runs jobs at their deadlines on a bounded pool of worker threads.
+        A job is an object with `name` and `step()` which does one round of work and returns
+        the number of seconds until the next round or None if the job is finished.
+    """
+
+    def __init__(self, workers):
+        self.cond = threading.Condition()
+        self.heap = []
+        self.counter = 0
+        self.woken = set()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+    def add(self, job, delay=0):
+        """ Schedule the next round of the job in `delay` seconds
+        """
+
+        with self.cond:
+            if stop_event.is_set():
+                return
+            if job in self.woken:
+                self.woken.discard(job)
+                delay = 0
+            self.counter += 1
+            heapq.heappush(self.heap, (time.monotonic() + delay, self.counter, job))
+            self.cond.notify()
+
+    def execute(self, job):
+        """ Do one round of the job and schedule the next one
+        """
+
+        try:
+            delay = job.step()
+        except Stopped:
+            logger.info('Job %s is interrupted' % job.name)
+            return
+        except Exception as err:
+            logger.error('Job %s failed. It will be restarted in %d seconds' % (job.name, SLEEP_ERROR_INTERVAL))
+            logger.error('Exception details: {}'.format(err))
+            delay = SLEEP_ERROR_INTERVAL
+
+        if delay is not None:
+            self.add(job, delay)
 
     def run(self):
-        thth = threading.current_thread()
+        """ Start due jobs until the scheduler is stopped
+        """
+
+        with self.cond:
+            while not stop_event.is_set():
+                if len(self.heap) == 0:
+                    self.cond.wait()
+                    continue
+                timeout = self.heap[0][0] - time.monotonic()
+                if timeout > 0:
+                    self.cond.wait(timeout)
+                    continue
+                job = heapq.heappop(self.heap)[2]
+                self.executor.submit(self.execute, job)
+
+    def wake(self, job):
+        """ Move the next round of a waiting job to now. A running job is woken as soon as its round is over
+        """
+
+        with self.cond:
+            for i, (deadline, counter, waiting) in enumerate(self.heap):
+                if waiting is job:
+                    self.heap[i] = (time.monotonic(), counter, job)
+                    heapq.heapify(self.heap)
+                    self.cond.notify()
+                    break
+            else:
+                self.woken.add(job)
+
+    def interrupt(self):
+        """ Interrupt waiting jobs and make run() return. It may be called from a job
+        """
+
+        stop_event.set()
+        with self.cond:
+            self.cond.notify()
 
-        # Read an offset from file
-        offset_id = read_offset()
+    def stop(self):
+        """ Interrupt waiting jobs and wait for the running ones to finish
+        """
 
-        # Form a query
-        query = ' OR '.join(WORDS)
+        self.interrupt()
+        self.executor.shutdown(wait=True)
+
+
+class LeaseLost(Exception):
+    """ Raised when a lease turns out to be taken over by another instance. The argument is the lease name
+    """
+
+
+class Leases(object):
+    """ Coordinates bot instances sharing the database. A job or a query shard is run by the instance
+        holding its lease: a row in the leases table with the owner and the expiration time.
+        Held leases are prolonged every LEASE_RENEW_INTERVAL seconds by a thread of their own, so jobs
+        blocking the scheduler's workers can't make them expire. A lease which isn't
+        prolonged for LEASE_TTL seconds, because its instance died or hung, is taken over by another one.
+        Every instance holds the 'instance:<id>' lease too, live instances are counted by them.
+    """
+
+    def __init__(self, db, instance_id):
+        self.db = db
+        self.instance_id = instance_id
+        self.lock = threading.Lock()
+
+        # Leases held by the instance and their expiration times
+        self.expires = {}
+        self.thread = None
+
+    def start(self):
+        """ Register the instance and start renewing its leases
+        """
+
+        self.acquire('instance:' + self.instance_id)
+        self.thread = threading.Thread(target=self.keep, name='lease_keeper', daemon=True)
+        self.thread.start()
+
+    def keep(self):
+        """ Keeper thread: prolong the leases until the bot is stopping
+        """
+
+        while not stop_event.wait(LEASE_RENEW_INTERVAL):
+            try:
+                self.renew()
+            except Exception as err:
+                logger.error('Can\'t renew leases')
+                logger.error('Exception details: {}'.format(err))
+
+    def stop(self):
+        """ Stop renewing and give away all the leases of the instance, so other instances take them at once
+        """
+
+        if self.thread is not None:
+            stop_event.set()
+            self.thread.join()
+            self.thread = None
+        self.release_all()
+
+    def take(self, cur, names, expires):
+        """ Take the leases which are free or expired and prolong the ones of the instance. Return the names taken
+        """
+
+        taken = []
+        for name in names:
+            cur.execute('INSERT OR IGNORE INTO leases VALUES (?,?,?)', (name, self.instance_id, expires))
+            cur.execute('UPDATE leases SET owner=?, expires=? WHERE name=? AND (owner=? OR expires<?)',
+                        (self.instance_id, expires, name, self.instance_id, time.time()))
+            if cur.rowcount > 0:
+                taken.append(name)
+
+        return taken
+
+    def acquire(self, name):
+        """ Take the lease or prolong it. Return whether the instance holds it
+        """
+
+        with self.lock:
+            # The lease is known to expire a bit earlier than it does in database
+            expires = time.time() + LEASE_TTL
+            if len(self.db.write(lambda cur: self.take(cur, [name], expires))) > 0:
+                self.expires[name] = expires
+                return True
+            self.expires.pop(name, None)
+
+        return False
+
+    def renew(self):
+        """ Prolong all the leases of the instance. Leases taken over by others are forgotten
+        """
+
+        with self.lock:
+            expires = time.time() + LEASE_TTL
+            taken = self.db.write(lambda cur: self.take(cur, sorted(self.expires), expires))
+            for name in list(self.expires):
+                if name in taken:
+                    self.expires[name] = expires
+                else:
+                    logger.warning('Lease %s is taken over by another instance' % name)
+                    del self.expires[name]
+            metrics.set('bot_leases_held', len(self.expires))
+
+    def holds(self, name):
+        """ Return whether the instance holds the lease and it isn't expired
+        """
+
+        with self.lock:
+            return self.expires.get(name, 0) > time.time()
+
+    def check(self, cur, names):
+        """ Make sure the instance still holds the leases, as part of a write.
+            Writes are serialized between instances, so no one can take them over until it is committed
+        """
+
+        for name in names:
+            cur.execute('SELECT 1 FROM leases WHERE name=? AND owner=? AND expires>=?',
+                        (name, self.instance_id, time.time()))
+            if cur.fetchone() is None:
+                raise LeaseLost(name)
+
+    def forget(self, name):
+        """ Stop considering the lease held, after LeaseLost
+        """
+
+        with self.lock:
+            self.expires.pop(name, None)
+
+    def release(self, name):
+        """ Give the lease away so another instance can take it at once
+        """
+
+        with self.lock:
+            self.db.write(lambda cur: cur.execute('DELETE FROM leases WHERE name=? AND owner=?',
+                                                  (name, self.instance_id)))
+            self.expires.pop(name, None)
+
+    def release_all(self):
+        """ Give away all the leases of the instance when it stops
+        """
+
+        with self.lock:
+            self.db.write(lambda cur: cur.execute('DELETE FROM leases WHERE owner=?', (self.instance_id,)))
+            self.expires.clear()
+
+    def instances(self):
+        """ Return the number of live instances
+        """
+
+        cur = self.db.reader().cursor()
+        cur.execute('SELECT COUNT(*) FROM leases WHERE name LIKE \'instance:%\' AND expires>=?', (time.time(),))
+
+        return cur.fetchone()[0]
+
+
+class TLeased(object):
+    """ Runs the job only on the instance holding the 'job:<job name>' lease. Other instances
+        check every LEASE_RENEW_INTERVAL seconds whether the lease is free to take the job over
+    """
+
+    def __init__(self, job, leases):
+        self.name = job.name
+        self.job = job
+        self.leases = leases
+        self.lease = 'job:' + job.name
+
+    def step(self):
+        if not self.leases.holds(self.lease):
+            if not self.leases.acquire(self.lease):
+                return LEASE_RENEW_INTERVAL
+            logger.info('Lease %s is taken. Job %s runs on this instance' % (self.lease, self.name))
+
+        try:
+            delay = self.job.step()
+        except LeaseLost as err:
+            logger.warning('Lease %s is lost' % err)
+            self.leases.forget(str(err))
+            return LEASE_RENEW_INTERVAL
+
+        if delay is None:
+            self.leases.release(self.lease)
+
+        return delay
+
+
+class TWatcher(object):
+    """ This job searches for tweets containing certain keywords.
+        Words are split into several queries if needed. Every query has its own offset,
+        queries are made concurrently and their results are merged.
+        With leases, queries are shards split between bot instances.
+        If poll_interval is given, searches are made every poll_interval seconds instead of the adaptive interval.
+    """
+
+    def __init__(self, name, api, db, leases=None, poll_interval=None, offset_file=OFFSET_FILE):
+        self.name = name
+        self.api = api
+        self.db = db
+        self.leases = leases
+        self.offset_file = offset_file
+        self.started = False
+
+        # Form queries. Only active ones are searched by this instance
+        self.queries = shard_query(WORDS)
+        self.active = list(self.queries) if leases is None else []
+        self.offsets = {}
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=SEARCH_WORKERS)
+
+        # Blacklists are kept in memory and reloaded when their files change
+        self.blacklist = BlacklistCache(BLACKLIST_USERS_FILE, BLACKLIST_WORDS_FILE)
+
+        # Recently handled tweets, to skip them even if offsets are lost
+        self.seen = SeenIndex(SEEN_INDEX_SIZE)
+        self.newest_id = 0
+        self.search_calls = 0
+
+        # Interval between searches adapts to traffic and the search quota
+        if poll_interval is None:
+            self.poll = AdaptivePoll(self.api, '/search/tweets')
+        else:
+            self.poll = AdaptivePoll(self.api, '/search/tweets', poll_interval, poll_interval, poll_interval)
+
+    @staticmethod
+    def save_queued(cur, queued):
+        """ Add queued tweets to the outbox
+        """
+
+        cur.executemany('INSERT OR IGNORE INTO outbox (tweet_id, created, user_id, user_sn, user_n, tweet_text) '
+                        'VALUES (?,?,?,?,?,?)', queued)
+
+    def checkpoint(self, queued, found, processed_id):
+        """ Save offsets in the same transaction as the tweets queued since the last checkpoint.
+            found is {query: [ids found by the query]}, tweets up to processed_id are handled.
+        """
+
+        offsets = dict(self.offsets)
+        for query, ids in found.items():
+            offsets[query] = max([offsets[query]] + [x for x in ids if x <= processed_id])
+        offset = max(offsets.values())
+
+        def save(cur):
+            # Offsets never go back, so only the shards which found tweets must still be ours
+            if self.leases is not None:
+                self.leases.check(cur, ['query:' + x for x, ids in found.items() if len(ids) > 0])
+            self.save_queued(cur, queued)
+            for query in found:
+                advance_offset(cur, offsets[query], 'offset:' + query)
+
+            return advance_offset(cur, offset)
+
+        offset = self.db.write(save)
+        self.offsets = offsets
+        del queued[:]
+        write_offset_file(offset, self.offset_file)
+        metrics.set('bot_offset_lag_seconds', snowflake_time(max(self.newest_id, offset)) - snowflake_time(offset))
+
+        for ids in found.values():
+            for x in ids:
+                if x <= processed_id:
+                    self.seen.add(x)
+
+    def start(self):
+        """ Connect to database and find out where to start searching from
+        """
+
+        cur = self.db.reader().cursor()
+
+        # Read an offset
+        offset_id = read_offset(cur, self.offset_file)
 
         # If an offset file doesn't exist or invalid, search for an offset
         if not offset_id:
             logger.info('Trying to get a new offset')
-            got_offset = False
-            while not got_offset:
-                try:
-                    offset_id = self.api.GetSearch(term=query, count=10, result_type='recent')[0].id
-                except Exception as err:
-                    logger.error('An error occurred. Sleep for %d seconds and try again...' % SLEEP_ERROR_INTERVAL)
-                    logger.error('Exception details: {}'.format(err))
-                    time.sleep(SLEEP_ERROR_INTERVAL)
-                else:
-                    got_offset = True
-                    logger.info('Done')
-            write_offset(offset_id)
+            offset_id = twitter_retry.call('Getting a new offset',
+                                           lambda: self.api.GetSearch(term=self.queries[0], count=10,
+                                                                      result_type='recent')[0].id,
+                                           self.api, '/search/tweets')
+            logger.info('Done')
+
+        # Every query continues from its own offset. New queries start from the common one
+        for query in self.queries:
+            cur.execute('SELECT value FROM state WHERE key=?', ('offset:' + query,))
+            row = cur.fetchone()
+            self.offsets[query] = row[0] if row is not None else offset_id
+        self.checkpoint([], {x: [] for x in self.queries}, offset_id)
+        logger.info('Searching with %d query(-ies)' % len(self.queries))
+
+        self.seen.seed(cur)
+        logger.info('%d handled tweet(s) loaded from database' % len(self.seen))
+
+        self.started = True
+
+    def search(self):
+        """ Make all queries concurrently. Return merged tweets from the oldest to the newest one
+            and {query: [ids found by the query]}. The number of API calls made is kept in search_calls
+        """
+
+        calls = collections.Counter()
+        futures = {query: self.executor.submit(lambda q: list(iter_search(self.api, q, self.offsets[q],
+                                                                          calls=calls)), query)
+                   for query in self.active}
+
+        merged = {}
+        found = {}
+        for query, future in futures.items():
+            statuses = future.result()
+            found[query] = [x.id for x in statuses]
+            for status in statuses:
+                merged[status.id] = status
+        self.search_calls = sum(calls.values())
+
+        return [merged[x] for x in sorted(merged)], found
+
+    def handle(self, res, queued):
+        """ Decide what to do with a found tweet. A valid one is added to queued. Return whether it is queued
+        """
+
+        if res.id in self.seen:
+            log_tweet(res, 'already_handled')
+            return False
+
+        if res.retweeted_status is not None:
+            log_tweet(res, 'already_retweeted')
+            return False
+        if self.blacklist.is_user_blacklisted(res.user):
+            log_tweet(res, 'blacklisted_user')
+            return False
+
+        # The text is scanned only when cheaper checks have passed
+        phrase = self.blacklist.search_phrase(res.text)
+        if phrase is not None:
+            log_tweet(res, 'blacklisted_word', phrase)
+        else:
+            log_tweet(res, 'valid_tweet')
+
+            # The retweet itself is made by TDispatcher. The tweet is queued in the same
+            # transaction as the offset, so it can't be lost between them
+            queued.append((res.id, res.created_at_in_seconds, res.user.id, res.user.screen_name,
+                           res.user.name, res.text))
+            return True
+
+        return False
+
+    def catch_up(self):
+        """ Search for tweets newer than the offsets and queue valid ones for retweeting.
+            Return the number of tweets found
+        """
+
+        logger.info('Making a new query...')
+        results, found = self.search()
+        queued = []
+        self.newest_id = max([self.newest_id] + [x.id for x in results])
+        metrics.inc('bot_tweets_fetched_total', len(results))
+        results = [x for x in results if x.user.id != MY_ID]
+        results_count = len(results)
+        if results_count > 0:
+            logger.info('Got %d new tweet(s)' % results_count)
+
+            # Check blacklists once per batch to be able to update them online
+            self.blacklist.refresh()
+
+            # Offsets are checkpointed once per batch or every OFFSET_COMMIT_INTERVAL seconds
+            # during long batches, not for every tweet
+            last_checkpoint = time.monotonic()
+            queued_count = 0
+
+            for res in results:
+                if self.handle(res, queued):
+                    queued_count += 1
+
+                if time.monotonic() - last_checkpoint >= OFFSET_COMMIT_INTERVAL:
+                    self.checkpoint(queued, found, res.id)
+                    last_checkpoint = time.monotonic()
+            logger.info('Queued %d tweet(s) for retweet', queued_count)
+        else:
+            logger.info('No new tweets found')
+
+        # Every found tweet is handled by now, including the bot's own ones which are just skipped
+        if any(len(x) > 0 for x in found.values()):
+            self.checkpoint(queued, found, max(max(x) for x in found.values() if len(x) > 0))
+
+        return results_count
+
+    def rebalance(self):
+        """ Take free query shards up to a fair share between live instances and give away the extra ones
+        """
+
+        share = math.ceil(len(self.queries) / max(self.leases.instances(), 1))
+        active = [x for x in self.active if self.leases.holds('query:' + x)]
+        for query in active[share:]:
+            logger.info('Giving away query: %s' % query)
+            self.leases.release('query:' + query)
+        active = active[:share]
+
+        cur = self.db.reader().cursor()
+        for query in self.queries:
+            if len(active) >= share:
+                break
+            if query in active or not self.leases.acquire('query:' + query):
+                continue
+
+            # The query may have been searched by another instance. Continue from where it stopped
+            cur.execute('SELECT value FROM state WHERE key=?', ('offset:' + query,))
+            row = cur.fetchone()
+            if row is not None:
+                self.offsets[query] = max(self.offsets[query], row[0])
+            logger.info('Took query: %s' % query)
+            active.append(query)
+
+        self.active = [x for x in self.queries if x in active]
+
+    def step(self):
+        """ Search for new tweets and queue valid ones for retweeting
+        """
+
+        if not self.started:
+            self.start()
+
+        if self.leases is not None:
+            self.rebalance()
+            if len(self.active) == 0:
+                return LEASE_RENEW_INTERVAL
+
+        try:
+            results_count = self.catch_up()
+        except LeaseLost as err:
+            logger.warning('Lease %s is taken over by another instance' % err)
+            self.leases.forget(str(err))
+            return 0
+
+        interval = self.poll.update(results_count, self.search_calls)
+        logger.info('Next search in %d seconds' % interval)
+
+        return interval
+
+
+class TStreamWatcher(TWatcher):
+    """ This job follows the filtered stream of tweets with WORDS and handles every tweet as it comes.
+        After every (re)connection the gap since the stored offsets is filled by search.
+        A stream silent for longer than the stream API timeout is considered stalled and reconnected.
+    """
+
+    def __init__(self, name, api, db, stream_api, decode_status, on_queued=None):
+        super().__init__(name, api, db)
+        self.stream_api = stream_api
+        self.decode_status = decode_status
+        self.on_queued = on_queued
+        self.reconnect_delay = 0
+
+    def read(self, messages, closed):
+        """ Reader thread: put stream messages to the queue, then None when the stream ends
+            or the exception it failed with. Reading stops at the next message once closed is set
+        """
+
+        try:
+            for message in self.stream_api.GetStreamFilter(track=WORDS, stall_warnings=True):
+                if stop_event.is_set() or closed.is_set():
+                    break
+                messages.put(message)
+        except Exception as err:
+            messages.put(err)
+        else:
+            messages.put(None)
+
+    def follow(self):
+        """ Handle tweets from the stream until it ends or fails.
+            The stream is read by a separate thread, so a quiet stream doesn't delay stopping the bot
+        """
+
+        logger.info('Connecting to the stream...')
+        messages = queue.Queue()
+        closed = threading.Event()
+        threading.Thread(target=self.read, args=(messages, closed), name='stream_reader', daemon=True).start()
+        try:
+            self.handle_messages(messages)
+        finally:
+            closed.set()
+
+    def handle_messages(self, messages):
+        """ Handle messages put by the reader thread. Valid tweets are saved to the outbox as they come,
+            offsets are checkpointed every OFFSET_COMMIT_INTERVAL seconds and when the stream ends
+        """
+
+        # Ids of stream tweets handled since the last checkpoint
+        handled = []
+        last_checkpoint = time.monotonic()
+        try:
+            connected = False
+            while True:
+                if len(handled) > 0 and time.monotonic() - last_checkpoint >= OFFSET_COMMIT_INTERVAL:
+                    self.checkpoint([], {x: handled for x in self.queries}, max(handled))
+                    handled = []
+                    last_checkpoint = time.monotonic()
 
-        # Initialize database
-        conn = sqlite3.connect(DB_FILE)
-        cur = conn.cursor()
-        cur.execute('''CREATE TABLE IF NOT EXISTS retweets (retweeted TIMESTAMP NOT NULL, created TIMESTAMP NOT NULL,
-                    user_id INTEGER NOT NULL, user_sn TEXT NOT NULL, user_n TEXT NOT NULL,
-                    tweet_id INTEGER NOT NULL, tweet_text TEXT NOT NULL,
-                    PRIMARY KEY (retweeted))''')
-        cur.execute('''CREATE TABLE IF NOT EXISTS stats
-                    (date TEXT NOT NULL, followers TEXT NOT NULL, PRIMARY KEY (date))''')
-        conn.commit()
-
-        stop_thread = False
-        while not stop_thread:
-            # Start working
-            logger.info('Making a new query...')
-            made_search = False
-            while not made_search:
                 try:
-                    results_tmp = self.api.GetSearch(term=query, since_id=offset_id)
-                except Exception as err:
-                    logger.error('An error occurred. Sleep for %d seconds and try again...' % SLEEP_ERROR_INTERVAL)
-                    logger.error('Exception details: {}'.format(err))
-                    time.sleep(SLEEP_ERROR_INTERVAL)
+                    message = messages.get(timeout=1)
+                except queue.Empty:
+                    if stop_event.is_set():
+                        return
+                    continue
+                if message is None:
+                    break
+                if isinstance(message, Exception):
+                    raise message
+                if stop_event.is_set():
+                    return
+
+                if not connected:
+                    # Tweets which came while there was no connection are searched for
+                    logger.info('Stream connected')
+                    connected = True
+                    self.reconnect_delay = 0
+                    self.catch_up()
+
+                if 'limit' in message:
+                    logger.warning('Stream limit: %d tweet(s) weren\'t delivered' % message['limit'].get('track', 0))
+                    metrics.inc('bot_stream_undelivered_total', message['limit'].get('track', 0))
+                    continue
+                if 'disconnect' in message:
+                    logger.warning('Stream is disconnected by the server: %s' % message['disconnect'].get('reason'))
+                    return
+                if 'warning' in message:
+                    logger.warning('Stream warning: %s' % message['warning'].get('message'))
+                    continue
+                if 'id' not in message or 'text' not in message:
+                    continue
+
+                res = self.decode_status(message)
+                metrics.inc('bot_tweets_fetched_total')
+                self.newest_id = max(self.newest_id, res.id)
+                queued = []
+                is_queued = False
+                if res.user.id != MY_ID:
+                    self.blacklist.refresh()
+                    is_queued = self.handle(res, queued)
+                handled.append(res.id)
+                self.seen.add(res.id)
+                if not is_queued:
+                    continue
+
+                # The tweet is saved right away, so it is retweeted without waiting for the offset checkpoint.
+                # If the bot stops before the checkpoint, the tweet is found again by search and skipped
+                self.db.write(lambda cur: self.save_queued(cur, queued))
+
+                logger.info('Queued tweet %d for retweet' % res.id)
+                if self.on_queued is not None:
+                    self.on_queued()
+
+            logger.warning('Stream is closed')
+        finally:
+            if len(handled) > 0:
+                self.checkpoint([], {x: handled for x in self.queries}, max(handled))
+
+    def step(self):
+        """ Follow the stream. When it breaks, reconnect after a growing delay
+        """
+
+        if not self.started:
+            self.start()
+
+        self.catch_up()
+        try:
+            self.follow()
+        except Stopped:
+            raise
+        except Exception as err:
+            logger.error('Stream error')
+            logger.error('Exception details: {}'.format(err))
+            metrics.inc('bot_stream_errors_total')
+
+        if stop_event.is_set():
+            return None
+
+        self.reconnect_delay = min(max(self.reconnect_delay * 2, STREAM_RECONNECT_MIN), STREAM_RECONNECT_MAX)
+        delay = self.reconnect_delay * random.uniform(0.5, 1)
+        logger.info('Reconnecting to the stream in %d seconds' % delay)
+
+        return delay
+
+
+class TDispatcher(object):
+    """ This job retweets tweets queued in the outbox by TWatcher.
+        Retweets are rate limited to `rate` per second with bursts of `burst`,
+        failed ones are retried with a growing delay.
+    """
+
+    def __init__(self, name, api, db, rate=RETWEET_RATE, burst=RETWEET_BURST):
+        self.name = name
+        self.api = api
+        self.db = db
+        self.bucket = TokenBucket(rate, burst)
+
+    def dispatch(self, row):
+        """ Retweet one tweet from the outbox and move it to the retweets table
+        """
+
+        cur = self.db.reader().cursor()
+        tweet_id, created, user_id, user_sn, user_n, tweet_text, attempts = row
+
+        logger.info('Retweeting tweet %d by %s (%d)...' % (tweet_id, user_sn, user_id))
+        cur.execute('SELECT 1 FROM retweets WHERE tweet_id=?', (tweet_id,))
+        if cur.fetchone() is not None:
+            logger.info('Already retweeted. Removing from outbox')
+            self.db.write(lambda c: c.execute('DELETE FROM outbox WHERE tweet_id=?', (tweet_id,)))
+            metrics.inc('bot_retweets_total', result='already_retweeted')
+            return
+
+        # Retweets are retried through the outbox, but they share the circuit breaker of the Twitter API
+        # with other jobs, so the dispatcher stops calling it too when it fails
+        twitter_retry.admit()
+        try:
+            with metrics.timer('bot_api_call_seconds', service='Twitter API', call='Retweeting'):
+                self.api.PostRetweet(tweet_id)
+        except Exception as err:
+            if TWITTER_ALREADY_RETWEETED not in twitter_error_codes(err):
+                metrics.inc('bot_api_errors_total', service='Twitter API', call='Retweeting')
+                retry_delay = twitter_retry.failed(err, self.api, '/statuses/retweet/:id')
+                attempts += 1
+                logger.error('Can\'t retweet (attempt %d of %d)' % (attempts, RETWEET_MAX_ATTEMPTS))
+                logger.error('Exception details: {}'.format(err))
+                if attempts >= RETWEET_MAX_ATTEMPTS:
+                    logger.error('Giving up. Removing from outbox')
+                    self.db.write(lambda c: c.execute('DELETE FROM outbox WHERE tweet_id=?', (tweet_id,)))
+                    metrics.inc('bot_retweets_total', result='gave_up')
                 else:
-                    made_search = True
-            results = [x for x in results_tmp if x.user.id != MY_ID]
-            results_count = len(results)
-            if results_count > 0:
-                logger.info('Got %d new tweet(s)' % results_count)
-                for i in range(results_count - 1, -1, -1):
-                    res = results[i]
-
-                    # Load blacklists every time they may be needed to be able to update them online.
-                    blacklist_users = read_and_prepare(BLACKLIST_USERS_FILE)
-                    blacklist_words = read_and_prepare(BLACKLIST_WORDS_FILE)
-
-                    logger.info('Tweet %d:' % (results_count - i))
-                    if res.retweeted_status is not None:
-                        log_tweet(res, 'already_retweeted')
-
-                        offset_id = res.id
-                        write_offset(offset_id)
-                    elif str(res.user.id) in blacklist_users or res.user.screen_name in blacklist_users:
-                        log_tweet(res, 'blacklisted_user')
-
-                        offset_id = res.id
-                        write_offset(offset_id)
-                    elif len([x for x in blacklist_words if x in res.text]) > 0:
-                        log_tweet(res, 'blacklisted_word')
-
-                        offset_id = res.id
-                        write_offset(offset_id)
-                    else:
-                        log_tweet(res, 'valid_tweet')
-
-                        try:
-                            self.api.PostRetweet(res.id)
-                        except Exception as err:
-                            logger.error('Can\'t retweet. Skipping')
-                            logger.error('Exception details: {}'.format(err))
-                        else:
-                            logger.info('Retweeted!')
-                            offset_id = res.id
-                            write_offset(offset_id)
-                            params = (str(datetime.datetime.now())[0:20], res.created_at, res.user.id,
-                                      res.user.screen_name, res.user.name, res.id, res.text)
-                            cur.execute('INSERT INTO retweets VALUES (?,?,?,?,?,?,?)', params)
-                            conn.commit()
-                            logger.info('Saved to database. Wait for a second...')
-                            time.sleep(1)
-            else:
-                logger.info('No new tweets found')
+                    # Not earlier than the shared policy waits after the error, such as until the rate limit reset
+                    delay = max(min(RETWEET_RETRY_INTERVAL * 2 ** (attempts - 1), RETWEET_RETRY_MAX_INTERVAL),
+                                retry_delay)
+                    logger.info('Will try again in %d seconds' % delay)
+                    self.db.write(lambda c: c.execute('UPDATE outbox SET attempts=?, next_try=? WHERE tweet_id=?',
+                                                      (attempts, time.time() + delay, tweet_id)))
+                    metrics.inc('bot_retweets_total', result='failed')
+                return
+            twitter_retry.succeeded()
+            logger.info('Twitter says it is already retweeted')
+        else:
+            twitter_retry.succeeded()
+            logger.info('Retweeted!')
+
+        params = (tweet_id, int(time.time()), created, user_id, user_sn, user_n, tweet_text)
+
+        def save(c):
+            c.execute('INSERT OR IGNORE INTO retweets (tweet_id, retweeted, created, user_id, user_sn, user_n, '
+                      'tweet_text) VALUES (?,?,?,?,?,?,?)', params)
+            save_hashtags(c, [(tweet_id, params[1], tweet_text)])
+            c.execute('DELETE FROM outbox WHERE tweet_id=?', (tweet_id,))
+
+        self.db.write(save)
+        metrics.inc('bot_retweets_total', result='retweeted')
+        logger.info('Saved to database')
+
+    def step(self):
+        """ Retweet due tweets while the rate limit allows
+        """
+
+        cur = self.db.reader().cursor()
+        while True:
+            cur.execute('SELECT tweet_id, created, user_id, user_sn, user_n, tweet_text, attempts FROM outbox '
+                        'WHERE next_try <= ? ORDER BY tweet_id LIMIT 1', (time.time(),))
+            row = cur.fetchone()
+            if row is None:
+                return DISPATCH_INTERVAL
+            if not self.bucket.consume():
+                return self.bucket.wait_time()
+            self.dispatch(row)
+
+
+class TReplayEnd(object):
+    """ This job stops the scheduler when a replayed capture is over: every recorded tweet is found
+        and the outbox is empty
+    """
 
-            for i in range(0, CHECK_INTERVAL*10):
-                if getattr(thth, 'stop_now', False):
-                    stop_thread = True
-                    break
-                time.sleep(0.1)
+    def __init__(self, name, replay, db, scheduler):
+        self.name = name
+        self.replay = replay
+        self.db = db
+        self.scheduler = scheduler
+
+    def step(self):
+        if not self.replay.finished():
+            return 0.1
+
+        cur = self.db.reader().cursor()
+        cur.execute('SELECT COUNT(*) FROM outbox')
+        if cur.fetchone()[0] > 0:
+            return 0.1
 
+        logger.info('Replay is over')
+        self.scheduler.interrupt()
 
-class TStatsMaker(threading.Thread):
-    """ This thread make and tweet statistics every Monday
+        return None
+
+
+class TStatsMaker(object):
+    """ This job make and tweet statistics every Monday
     """
 
-    def __init__(self, name, api):
-        super(TStatsMaker, self).__init__()
+    def __init__(self, name, api, db):
         self.name = name
         self.api = api
+        self.db = db
+
+    def post_stats(self):
+        """ Save today's followers list and tweet the last week statistics unless it is done already
+        """
+
+        cur = self.db.reader().cursor()
+
+        logger.info('Seems today is Monday. Time to post stats')
+
+        logger.info('Getting today\'s stats from db...')
+        today = datetime.date.today()
+        cur.execute('SELECT 1 FROM follower_snapshots WHERE date=?', (str(today),))
+        followers_db = cur.fetchone()
+        logger.info('Done')
+        if followers_db is None:
+            logger.info('Stats was not posted today')
+
+            logger.info('Saving today\'s stats...')
+            logger.info('Getting followers list...')
+            followers = twitter_retry.call('Getting followers list',
+                                           lambda: self.api.GetFollowerIDs(user_id=MY_ID),
+                                           self.api, '/followers/ids')
+            followers = sorted(set(followers))
+            logger.info('Got followers list')
+
+            logger.info('Getting previous stats...')
+            cur.execute('SELECT ids FROM follower_snapshots WHERE date<? ORDER BY date DESC LIMIT 1',
+                        (str(today),))
+            followers_old = cur.fetchone()
+            if followers_old is not None:
+                logger.info('Found some data')
+                followers_added, followers_removed = diff_sorted(unpack_ids(followers_old[0]), followers)
+            else:
+                logger.info('There is no previous data')
+                followers_added, followers_removed = [], []
+
+            def save(c):
+                c.executemany('INSERT INTO follower_events VALUES (?,?,1)', ((str(today), x) for x in followers_added))
+                c.executemany('INSERT INTO follower_events VALUES (?,?,0)', ((str(today), x) for x in followers_removed))
+                c.execute('INSERT INTO follower_snapshots VALUES (?,?,?)',
+                          (str(today), len(followers), pack_ids(followers)))
+
+            self.db.write(save)
+            logger.info('Data saved')
+
+            followers_added, followers_removed = follower_churn(cur, today - datetime.timedelta(days=6),
+                                                                today)
+
+            logger.info('Getting last week retweets...')
+            retweets_count = retweet_stats(cur, today - datetime.timedelta(days=7),
+                                           today - datetime.timedelta(days=1))[0]
+            logger.info('Done')
+
+            logger.info('Forming a tweet and sending...')
+            text = 'Статистика прошедшей недели:\n\n'
+            text += 'Всего фолловеров: %d\n' % len(followers)
+            if followers_added > 0:
+                text += 'Новых: %d\n' % followers_added
+            if followers_removed > 0:
+                text += 'Отписавшихся: %d\n' % followers_removed
+            text += '\nВсего ретвитов: %d\n' % retweets_count
+            text += '\n#AllMagadanWeekly'
+            logger.info('Stat data:\n' + text)
+
+            logger.info('Tweet length: {}'.format(len(text)))
+            twitter_retry.call('Sending stats', lambda: self.api.PostUpdate(text))
+            logger.info('Done')
+        else:
+            logger.info('Stats already have been posted today')
+
+    def step(self):
+        """ Post stats if today is Monday. Check again when the next day starts
+        """
+
+        if datetime.datetime.isoweekday(datetime.datetime.now()) == 1:
+            self.post_stats()
+
+        now = datetime.datetime.now()
+        tomorrow = (now + datetime.timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+
+        return (tomorrow - now).total_seconds() + 1
+
+
+def format_temperature(value):
+    """ Return the temperature with a sign and the matching form of the word 'degree'
+    """
 
-    def run(self):
-        thth = threading.current_thread()
+    if not value.startswith('-'):
+        value = '+' + value
+    if int(value) == 0:
+        value = '0'
+    if value[-1] == '1':
+        word = 'градус'
+    elif value[-1] in ('2', '3', '4'):
+        word = 'градуса'
+    else:
+        word = 'градусов'
 
-        # Initialize database
-        conn = sqlite3.connect(DB_FILE)
-        cur = conn.cursor()
-        cur.execute('''CREATE TABLE IF NOT EXISTS retweets
-                    (retweeted TIMESTAMP NOT NULL, created TIMESTAMP NOT NULL,
-                    user_id INTEGER NOT NULL, user_sn TEXT NOT NULL, user_n TEXT NOT NULL,
-                    tweet_id INTEGER NOT NULL, tweet_text TEXT NOT NULL,
-                    PRIMARY KEY (retweeted))''')
-        cur.execute('''CREATE TABLE IF NOT EXISTS stats
-                    (date TEXT NOT NULL, followers TEXT NOT NULL, PRIMARY KEY (date))''')
-        conn.commit()
-
-        # Whether the day of the week was checked
-        week_day_checked = False
-
-        stop_thread = False
-        while not stop_thread:
-            if datetime.datetime.isoweekday(datetime.datetime.now()) == 1:
-                if not week_day_checked:
-                    logger.info('Seems today is Monday. Time to post stats')
-
-                    logger.info('Getting today\'s stats from db...')
-                    cur.execute('SELECT * FROM stats WHERE date=\'%s\'' % datetime.date.today())
-                    conn.commit()
-                    followers_db = cur.fetchone()
-                    logger.info('Done')
-                    if followers_db is None:
-                        logger.info('Stats was not posted today')
-
-                        logger.info('Saving today\'s stats...')
-                        logger.info('Getting followers list...')
-                        got_followers = False
-                        while not got_followers:
-                            try:
-                                followers = self.api.GetFollowerIDs(user_id=MY_ID, stringify_ids=True)
-                            except Exception as err:
-                                logger.error('Can\'t get followers list. Will sleep for %d seconds and try again'
-                                             % SLEEP_ERROR_INTERVAL)
-                                logger.error('Exception details: {}'.format(err))
-                                time.sleep(SLEEP_ERROR_INTERVAL)
-                            else:
-                                logger.info('Got followers list')
-                                got_followers = True
-                        cur.execute('INSERT INTO stats VALUES (?,?)', (datetime.date.today(), ','.join(followers)))
-                        conn.commit()
-                        logger.info('Data saved')
-
-                        logger.info('Getting last Monday\'s stats...')
-                        cur.execute('SELECT * FROM stats WHERE date=\'%s\''
-                                    % (datetime.date.today() - datetime.timedelta(days=7)))
-                        conn.commit()
-                        followers_old_s = cur.fetchone()[1]
-                        logger.info('Done')
-                        if followers_old_s is not None:
-                            logger.info('Found some data')
-                            followers_old = followers_old_s.split(',')
-                            followers_added = [x for x in followers if x not in followers_old]
-                            followers_removed = [x for x in followers_old if x not in followers]
-                        else:
-                            logger.info('There is no last Monday\'s data')
-                            followers_added = list()
-                            followers_removed = list()
-
-                        logger.info('Getting last week retweets...')
-                        cur.execute('SELECT * FROM retweets WHERE retweeted BETWEEN \'%s\' AND \'%s\''
-                                    % (str(datetime.date.today() - datetime.timedelta(days=7))[0:10] + ' 00:00:00',
-                                       str(datetime.date.today() - datetime.timedelta(days=1))[0:10] + ' 23:59:59'))
-                        conn.commit()
-                        res = cur.fetchall()
-                        logger.info('Done')
-
-                        logger.info('Forming a tweet and sending...')
-                        text = 'Статистика прошедшей недели:\n\n'
-                        text += 'Всего фолловеров: %d\n' % len(followers)
-                        if len(followers_added) > 0:
-                            text += 'Новых: %d\n' % len(followers_added)
-                        if len(followers_removed) > 0:
-                            text += 'Отписавшихся: %d\n' % len(followers_removed)
-                        text += '\nВсего ретвитов: %d\n' % len(res)
-                        text += '\n#AllMagadanWeekly'
-                        logger.info('Stat data:\n' + text)
-
-                        stats_sent = False
-                        logger.info('Tweet length: {}'.format(len(text)))
-                        while not stats_sent:
-                            try:
-                                self.api.PostUpdate(text)
-                            except Exception as err:
-                                logger.error(
-                                    'Can\'t send stats. Will sleep for %d seconds and try again' % SLEEP_ERROR_INTERVAL)
-                                logger.error('Exception details: {}'.format(err))
-                                time.sleep(SLEEP_ERROR_INTERVAL)
-                            else:
-                                stats_sent = True
-                        logger.info('Done')
-                    else:
-                        logger.info('Stats already have been posted today')
-                    week_day_checked = True
-            else:
-                week_day_checked = False
+    return value, word
 
-            for i in range(0, CHECK_INTERVAL*10):
-                if getattr(thth, 'stop_now', False):
-                    stop_thread = True
-                    break
-                time.sleep(0.1)
+
+def format_conditions(period):
+    """ Describe weather conditions for a forecast period
+    """
+
+    val_temp, temp_lang = format_temperature(period[4].attrib['value'])
+    val_press = math.floor(float(period[5].attrib['value']) * 0.75006)
+    val_winddir = period[2].attrib['code']
+    val_windspeed = float(period[3].attrib['mps'])
+    val_weathercode = period[0].attrib['number']
+
+    text = '%s, %s %s.' % (WEATHER_CODES[val_weathercode], val_temp, temp_lang)
+    text += ' Давление %d мм рт.ст.' % val_press
+    text += '\nВетер %s, %d м/с.' % (WIND_DIRECTIONS[val_winddir], val_windspeed)
+
+    return text
 
 
-class TWeather(threading.Thread):
-    """ This thread make and tweet weather information every 3 hour
-        and weather forecast once a day
+def render_weather(root, slot):
+    """ Form the weather tweet for the slot time from the hour by hour forecast
     """
 
-    def __init__(self, name, api):
-        super(TWeather, self).__init__()
+    # Cached data may start in the past, so take the first period which isn't over at the slot time
+    slot_s = slot.strftime('%Y-%m-%dT%H:%M:%S')
+    periods = root.findall('./forecast/tabular/time')
+    forecast_now = next((x for x in periods if x.attrib['to'] > slot_s), periods[0])
+
+    text = 'Погода на %s:\n\n' % forecast_now.attrib['from'][11:16]
+    text += format_conditions(forecast_now)
+    text += '\n\n#AllMagadanWeather'
+
+    return [text]
+
+
+def render_forecast(root, slot):
+    """ Form the day and the night forecast tweets for the day after the slot
+    """
+
+    # Periods are found by their dates: the forecast may have been loaded hours before the slot.
+    # The night is the one following the day
+    tomorrow = slot + datetime.timedelta(1)
+    day_s = tomorrow.strftime('%Y-%m-%d')
+    night_s = (tomorrow + datetime.timedelta(1)).strftime('%Y-%m-%d')
+    periods = root.findall('./forecast/tabular/time')
+    forecast_day = next((x for x in periods if x.attrib['period'] == '2' and x.attrib['from'][0:10] == day_s), None)
+    forecast_night = next((x for x in periods if x.attrib['period'] == '0' and x.attrib['from'][0:10] == night_s), None)
+    if forecast_day is None or forecast_night is None:
+        raise ValueError('The forecast has no data for %s' % day_s)
+
+    text_day = 'Прогноз на {:02d}.{:02d}\n\n'.format(tomorrow.day, tomorrow.month)
+    text_day += 'Днем:\n'
+    text_day += format_conditions(forecast_day)
+    text_day += '\n\n#AllMagadanForecast'
+
+    text_night = 'Прогноз на {:02d}.{:02d}\n\n'.format(tomorrow.day, tomorrow.month)
+    text_night += 'Ночью:\n'
+    text_night += format_conditions(forecast_night)
+    text_night += '\n\n#AllMagadanForecast'
+
+    return [text_day, text_night]
+
+
+def next_slot(kind, after):
+    """ Return the first posting time of the kind ('weather' every 3 hours or 'forecast' at 21:00)
+        not earlier than `after`
+    """
+
+    slot = after.replace(minute=0, second=0, microsecond=0)
+    if slot < after:
+        slot += datetime.timedelta(hours=1)
+    if kind == 'weather':
+        while slot.hour % 3 != 0:
+            slot += datetime.timedelta(hours=1)
+    else:
+        while slot.hour != 21:
+            slot += datetime.timedelta(hours=1)
+
+    return slot
+
+
+class TWeather(object):
+    """ This job make and tweet weather information every 3 hour
+        and weather forecast once a day.
+        Tweets are prepared WEATHER_PREFETCH_MINUTES before their time, so only sending is left at the time.
+    """
+
+    # Tweets renderer for every kind of posts
+    KINDS = {'weather': render_weather,
+             'forecast': render_forecast}
+
+    def __init__(self, name, api, db=None):
         self.name = name
         self.api = api
+        self.db = db
+
+        # Parsed forecasts and their urls
+        self.forecasts = ForecastCache()
+        self.urls = {'weather': FORECAST_URL_HOUR,
+                     'forecast': FORECAST_URL}
+
+        # Next posting time and prepared tweets for every kind of posts
+        now = datetime.datetime.now().replace(second=0, microsecond=0)
+        self.slots = {kind: next_slot(kind, now) for kind in self.KINDS}
+        self.prepared = {kind: None for kind in self.KINDS}
+
+    def prepare(self, kind):
+        """ Load the forecast and form tweets for the next slot of the kind
+        """
+
+        url = self.urls[kind]
+
+        logger.info('Preparing %s tweets for %s...' % (kind, self.slots[kind].strftime('%H:%M')))
+        root = forecast_retry.call('Loading weather data', lambda: self.forecasts.get(url))
+        self.prepared[kind] = self.KINDS[kind](root, self.slots[kind])
+        for text in self.prepared[kind]:
+            logger.info('Weather data:\n' + text)
+        logger.info('Done')
+
+    def claim(self, kind):
+        """ Mark the slot of the kind as posted unless it is marked already. Return whether it is claimed.
+            Writes are serialized between instances, so only one of them claims a slot
+        """
+
+        key = 'posted:' + kind
+        slot = int(self.slots[kind].timestamp())
+
+        def save(cur):
+            cur.execute('SELECT value FROM state WHERE key=?', (key,))
+            row = cur.fetchone()
+            if row is not None and row[0] >= slot:
+                return False
+            cur.execute('INSERT OR REPLACE INTO state VALUES (?,?)', (key, slot))
+            return True
+
+        return self.db.write(save)
+
+    def post(self, kind):
+        """ Send prepared tweets of the kind. With a database, the slot is claimed before sending,
+            so an instance taking the job over meanwhile doesn't post it again
+        """
+
+        logger.info('Current time is %s. Time to post %s' % (datetime.datetime.now().strftime('%H:%M'), kind))
+        if self.db is not None and not self.claim(kind):
+            logger.info('It is posted already')
+            return
+
+        for text in self.prepared[kind]:
+            logger.info('Tweet length: {}'.format(len(text)))
+            twitter_retry.call('Sending tweet', lambda: self.api.PostUpdate(text))
+        logger.info('Done')
+
+    def skip_missed(self, kind):
+        """ Move to the next slot of the kind if the current one is over WEATHER_GRACE_MINUTES late.
+            Return whether it is missed
+        """
+
+        now = datetime.datetime.now()
+        slot = self.slots[kind]
+        if now - slot <= datetime.timedelta(minutes=WEATHER_GRACE_MINUTES):
+            return False
+
+        logger.warning('Missed %s post for %s' % (kind, slot.strftime('%H:%M')))
+        self.slots[kind] = next_slot(kind, now)
+        self.prepared[kind] = None
 
-    def run(self):
-        thth = threading.current_thread()
-
-        # Whether the weather is checked
-        current_weather_checked = False
-        forecast_checked = False
-
-        stop_thread = False
-        while not stop_thread:
-            now = datetime.datetime.now()
-            if (now.hour % 3 == 0) and (now.minute == 0):
-                if not current_weather_checked:
-                    logger.info('Current time is %d:%d. Time to post weather' % (now.hour, now.minute))
-
-                    if not os.path.isdir(TEMP_DIR):
-                        os.mkdir(TEMP_DIR)
-
-                    logger.info('Loading weather data...')
-                    got_weather = False
-                    while not got_weather:
-                        try:
-                            with urllib.request.urlopen(FORECAST_URL_HOUR) as response:
-                                yr_xml = response.read()
-                        except Exception as err:
-                            logger.error('Error. Will sleep for %d seconds and try again' % SLEEP_ERROR_INTERVAL)
-                            logger.error('Exception details: {}'.format(err))
-                            time.sleep(SLEEP_ERROR_INTERVAL)
-                        else:
-                            got_weather = True
-                            logger.info('Done')
-
-                    yr_xml_decoded = yr_xml.decode('utf-8')
-                    with open(os.path.join(TEMP_DIR, YR_HOUR_FILE), 'w') as f:
-                        f.write(yr_xml_decoded)
-
-                    tree = ET.parse(os.path.join(TEMP_DIR, YR_HOUR_FILE))
-                    root = tree.getroot()
-
-                    forecast_now = root.find('./forecast/tabular/time')
-
-                    val_temp = forecast_now[4].attrib['value']
-                    if not val_temp.startswith('-'):
-                        val_temp = '+' + val_temp
-                    if int(val_temp) == 0:
-                        val_temp = '0'
-                    if val_temp[-1] == '1':
-                        temp_lang = 'градус'
-                    elif val_temp[-1] in ('2', '3', '4'):
-                        temp_lang = 'градуса'
-                    else:
-                        temp_lang = 'градусов'
-                    val_press = math.floor(float(forecast_now[5].attrib['value']) * 0.75006)
-                    val_winddir = forecast_now[2].attrib['code']
-                    val_windspeed = float(forecast_now[3].attrib['mps'])
-                    val_weathercode = forecast_now[0].attrib['number']
-
-                    logger.info('Forming a tweet and sending...')
-                    text = 'Погода на %s:\n\n' % forecast_now.attrib['from'][11:16]
-                    text += '%s, %s %s.' % (WEATHER_CODES[val_weathercode], val_temp, temp_lang)
-                    text += ' Давление %d мм рт.ст.' % val_press
-                    text += '\nВетер %s, %d м/с.' % (WIND_DIRECTIONS[val_winddir], val_windspeed)
-                    text += '\n\n#AllMagadanWeather'
-                    logger.info('Weather data:\n' + text)
-
-                    weather_sent = False
-                    logger.info('Tweet length: {}'.format(len(text)))
-                    while not weather_sent:
-                        try:
-                            self.api.PostUpdate(text)
-                        except Exception as err:
-                            logger.error(
-                                'Can\'t send tweet. Will sleep for %d seconds and try again' % SLEEP_ERROR_INTERVAL)
-                            logger.error('Exception details: {}'.format(err))
-                            time.sleep(SLEEP_ERROR_INTERVAL)
-                        else:
-                            weather_sent = True
-                    logger.info('Done')
-                    current_weather_checked = True
-                else:
-                    logger.info('Weather already have been posted')
-            else:
-                current_weather_checked = False
-
-            if (now.hour == 21) and (now.minute == 0):
-                if not forecast_checked:
-                    logger.info('Current time is %d:%d. Time to post weather forecast for the next day' % (now.hour, now.minute))
-
-                    if not os.path.isdir(TEMP_DIR):
-                        os.mkdir(TEMP_DIR)
-
-                    logger.info('Loading weather data...')
-                    got_weather = False
-                    while not got_weather:
-                        try:
-                            with urllib.request.urlopen(FORECAST_URL) as response:
-                                yr_xml = response.read()
-                        except Exception as err:
-                            logger.error('Error. Will sleep for %d seconds and try again' % SLEEP_ERROR_INTERVAL)
-                            logger.error('Exception details: {}'.format(err))
-                            time.sleep(SLEEP_ERROR_INTERVAL)
-                        else:
-                            got_weather = True
-                            logger.info('Done')
-
-                    yr_xml_decoded = yr_xml.decode('utf-8')
-                    with open(os.path.join(TEMP_DIR, YR_FILE), 'w') as f:
-                        f.write(yr_xml_decoded)
-
-                    tree = ET.parse(os.path.join(TEMP_DIR, YR_FILE))
-                    root = tree.getroot()
-
-                    forecast_day = root.findall('./forecast/tabular/time[@period="2"]')[0]
-                    forecast_night = root.findall('./forecast/tabular/time[@period="0"]')[1]
-
-                    tomorrow = now + datetime.timedelta(1)
-
-                    val_day_temp = forecast_day[4].attrib['value']
-                    if not val_day_temp.startswith('-'):
-                        val_day_temp = '+' + val_day_temp
-                    if not val_day_temp.startswith('-'):
-                        val_day_temp = '+' + val_day_temp
-                    if int(val_day_temp) == 0:
-                        val_day_temp = '0'
-                    if val_day_temp[-1] == '1':
-                        temp_lang = 'градус'
-                    elif val_day_temp[-1] in ('2', '3', '4'):
-                        temp_lang = 'градуса'
-                    else:
-                        temp_lang = 'градусов'
-
-                    val_day_press = math.floor(float(forecast_day[5].attrib['value']) * 0.75006)
-                    val_day_winddir = forecast_day[2].attrib['code']
-                    val_day_windspeed = float(forecast_day[3].attrib['mps'])
-                    val_day_weathercode = forecast_day[0].attrib['number']
-
-                    logger.info('Forming a day forecast tweet and sending...')
-                    text = 'Прогноз на {:02d}.{:02d}\n\n'.format(tomorrow.day, tomorrow.month)
-                    text += 'Днем:\n'
-                    text += '%s, %s %s.' % (WEATHER_CODES[val_day_weathercode], val_day_temp, temp_lang)
-                    text += ' Давление %d мм рт.ст.' % val_day_press
-                    text += '\nВетер %s, %d м/с.' % (WIND_DIRECTIONS[val_day_winddir], val_day_windspeed)
-                    text += '\n\n#AllMagadanForecast'
-                    logger.info('Weather data:\n' + text)
-
-                    weather_sent = False
-                    logger.info('Tweet length: {}'.format(len(text)))
-                    while not weather_sent:
-                        try:
-                            self.api.PostUpdate(text)
-                        except Exception as err:
-                            logger.error(
-                                'Can\'t send tweet. Will sleep for %d seconds and try again' % SLEEP_ERROR_INTERVAL)
-                            logger.error('Exception details: {}'.format(err))
-                            time.sleep(SLEEP_ERROR_INTERVAL)
-                        else:
-                            weather_sent = True
-                    logger.info('Done')
-
-                    val_night_temp = forecast_night[4].attrib['value']
-                    if not val_night_temp.startswith('-'):
-                        val_night_temp = '+' + val_night_temp
-                    if not val_night_temp.startswith('-'):
-                        val_night_temp = '+' + val_night_temp
-                    if int(val_night_temp) == 0:
-                        val_night_temp = '0'
-                    if val_night_temp[-1] == '1':
-                        temp_lang = 'градус'
-                    elif val_night_temp[-1] in ('2', '3', '4'):
-                        temp_lang = 'градуса'
-                    else:
-                        temp_lang = 'градусов'
-
-                    val_night_press = math.floor(float(forecast_night[5].attrib['value']) * 0.75006)
-                    val_night_winddir = forecast_night[2].attrib['code']
-                    val_night_windspeed = float(forecast_night[3].attrib['mps'])
-                    val_night_weathercode = forecast_night[0].attrib['number']
-
-                    logger.info('Forming a night forecast tweet and sending...')
-                    text = 'Прогноз на {:02d}.{:02d}\n\n'.format(tomorrow.day, tomorrow.month)
-                    text += 'Ночью:\n'
-                    text += '%s, %s %s.' % (WEATHER_CODES[val_night_weathercode], val_night_temp, temp_lang)
-                    text += ' Давление %d мм рт.ст.' % val_night_press
-                    text += '\nВетер %s, %d м/с.' % (WIND_DIRECTIONS[val_night_winddir], val_night_windspeed)
-                    text += '\n\n#AllMagadanForecast'
-                    logger.info('Weather data:\n' + text)
-
-                    weather_sent = False
-                    logger.info('Tweet length: {}'.format(len(text)))
-                    while not weather_sent:
-                        try:
-                            self.api.PostUpdate(text)
-                        except Exception as err:
-                            logger.error(
-                                'Can\'t send tweet. Will sleep for %d seconds and try again' % SLEEP_ERROR_INTERVAL)
-                            logger.error('Exception details: {}'.format(err))
-                            time.sleep(SLEEP_ERROR_INTERVAL)
-                        else:
-                            weather_sent = True
-                    logger.info('Done')
-
-                    forecast_checked = True
-                else:
-                    logger.info('Forecast already have been posted')
-            else:
-                forecast_checked = False
+        return True
 
-            for i in range(0, 100):
-                if getattr(thth, 'stop_now', False):
-                    stop_thread = True
-                    break
-                time.sleep(0.1)
+    def step(self):
+        """ Prepare tweets which time is near and post tweets which time has come.
+            Return the time until the next of these events
+        """
+
+        for kind in self.KINDS:
+            if self.skip_missed(kind):
+                continue
+
+            slot = self.slots[kind]
+            if (self.prepared[kind] is None
+                    and datetime.datetime.now() >= slot - datetime.timedelta(minutes=WEATHER_PREFETCH_MINUTES)):
+                self.prepare(kind)
+
+            if datetime.datetime.now() >= slot:
+                # Loading the forecast may have been retried for long
+                if self.skip_missed(kind):
+                    continue
+                self.post(kind)
+                self.slots[kind] = next_slot(kind, slot + datetime.timedelta(minutes=1))
+                self.prepared[kind] = None
+
+        events = [self.slots[kind] if self.prepared[kind] is not None
+                  else self.slots[kind] - datetime.timedelta(minutes=WEATHER_PREFETCH_MINUTES)
+                  for kind in self.KINDS]
+
+        return (min(events) - datetime.datetime.now()).total_seconds()